@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# encoding:utf8
+
+"""
+Benchmarks, against a Redis you can flood.
+
+    bench.py hose [REDIS_HOST [COUNT]]
+    bench.py parallel EVENTS.jsonl [ACTION [WORKERS]]
+    bench.py errors [COUNT]
+    bench.py trackers [COUNT|EVENTS.jsonl[.gz] [RESULTS.json [TRACKER,...]]]
+    bench.py compare BEFORE.json AFTER.json
+"""
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import json
+import platform
+import re
+import resource
+import time
+from multiprocessing import Process, Pipe
+
+import gevent
+import redis
+
+from elasticstat import (EventsHose, Event, MESSAGES, Source, loads,
+                         TrackBulkSize, TrackBulkError, TrackSlowSearch,
+                         TrackSearchShapes, TrackUsers, TrackLatency,
+                         TrackErrors)
+from parallel import Coordinator
+from replay import lines as read_lines
+from synth import Traffic
+import error
+
+
+def percentile(values, p):
+    "p-th percentile of an already sorted list"
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def packet(agent='bench'):
+    return {'@timestamp': '2014-11-21T10:00:00.000Z', 'responsetime': 1,
+            'src_ip': '127.0.0.1', 'agent': agent, 'http': None,
+            'sent': time.time()}
+
+
+def poll(r, chan):
+    "The former EventsHose loop: one message per turn, 100 ms nap when idle."
+    pubsub = r.pubsub()
+    pubsub.psubscribe(chan)
+    while True:
+        msg = pubsub.get_message()
+        if msg is None:
+            time.sleep(0.1)
+            continue
+        if msg['type'] in MESSAGES:
+            yield Event(json.loads(msg['data']))
+
+
+def publish(r, chan, count, burst=100, pause=0.01):
+    "Publish count packets, by bursts."
+    sent = 0
+    while sent < count:
+        n = min(burst, count - sent)
+        p = r.pipeline(transaction=False)
+        for i in range(n):
+            p.publish(chan, json.dumps(packet()))
+        p.execute()
+        sent += n
+        gevent.sleep(pause)
+
+
+def consume(events, count):
+    "Latencies, in ms, of the first count events"
+    latencies = []
+    for event in events:
+        latencies.append((time.time() - event.raw['sent']) * 1000)
+        if len(latencies) >= count:
+            return latencies
+
+
+def bench_hose(host='localhost', count=100000):
+    r = redis.StrictRedis(host=host, port=6379, db=0)
+    chan = 'bench/hose'
+    for name, events in [('poll', poll(r, 'bench/*')),
+                         ('batches', iter(EventsHose(r, 'bench/*')))]:
+        consumer = gevent.spawn(consume, events, count)
+        gevent.sleep(0.1)  # let it subscribe
+        start = time.time()
+        gevent.spawn(publish, redis.StrictRedis(host=host, port=6379, db=0),
+                     chan, count)
+        latencies = sorted(consumer.get())
+        duration = time.time() - start
+        print "{name:8} {rate:8.0f} events/s latency ms: mean {mean:.1f} \
+p50 {p50:.1f} p99 {p99:.1f} max {max:.1f}".format(
+            name=name, rate=count / duration,
+            mean=sum(latencies) / len(latencies),
+            p50=percentile(latencies, 50), p99=percentile(latencies, 99),
+            max=latencies[-1])
+
+
+def bench_parallel(path, action='users', workers=4, batch_size=1000):
+    "Scaling of parallel analysis, over a file of packets, one per line"
+    with open(path) as f:
+        lines = [('file', line) for line in f]
+    batches = [lines[i:i + batch_size]
+               for i in range(0, len(lines), batch_size)]
+    single = None
+    for n in range(1, workers + 1):
+        start = time.time()
+        tally = list(Coordinator(action, n, 'round', interval=3600)
+                     .run(batches))[-1]
+        rate = len(lines) / (time.time() - start)
+        if single is None:
+            single = rate
+        print "{n:2} workers {rate:8.0f} events/s x{speedup:.2f} \
+{keys} keys".format(n=n, rate=rate, speedup=rate / single, keys=len(tally))
+
+
+SearchPhaseExecutionException = re.compile("(?P<blah>.*?); shardFailures (?P<details>.*)\]", re.MULTILINE)
+ShardDetails = re.compile("\{(?P<shard>\[.+?\]\[.+?\]\[.+?\]): (?P<detail>.*?); \}", re.MULTILINE)
+
+
+def regex_parse(raw):
+    "The former parser, lazy regexes"
+    name, blob = raw.split('[', 1)
+    r = dict(name=name, description='', exceptions={})
+    if name == "SearchPhaseExecutionException":
+        m = SearchPhaseExecutionException.match(blob)
+        r['description'] = m.group('blah')
+        details = m.group('details')
+        for s in ShardDetails.finditer(details):
+            k = s.group('shard')
+            r['exceptions'][k] = []
+            for n in s.group('detail').split('; nested: '):
+                nname, ndetail = n.split('[', 1)
+                if nname not in error.boring_exceptions:
+                    r['exceptions'][k].append({nname: ndetail[:-1]})
+    else:
+        r['description'] = blob[:-1]
+    return r
+
+
+def bench_errors(count=1000):
+    "Parsing the sample errors: regexes, tokenizer, tokenizer and cache"
+    for i, raw in enumerate(error.SAMPLES):
+        for name, parse in [('regex', regex_parse), ('tokenizer', error.parse),
+                            ('cached', error.parseElasticsearchError)]:
+            start = time.time()
+            for n in xrange(count):
+                # a new string each time, like errors coming from the wire
+                parse(raw[:-1] + ']')
+            print "sample {i} ({size} bytes) {name:10} {us:8.1f} µs".format(
+                i=i, size=len(raw), name=name,
+                us=(time.time() - start) * 1e6 / count)
+
+
+class Lines(Source):
+    """Packets of a list, by batches. With marks, the time each batch is
+    pulled is appended to it."""
+    def __init__(self, lines, batch_size=1000, marks=None):
+        Source.__init__(self)
+        self.lines = lines
+        self.batch_size = batch_size
+        self.marks = marks
+
+    def raw_batches(self):
+        for i in xrange(0, len(self.lines), self.batch_size):
+            if self.marks is not None:
+                self.marks.append(time.time())
+            yield [('bench', line)
+                   for line in self.lines[i:i + self.batch_size]]
+
+
+def run_tracker(tracker, lines, batch_size, marks=None):
+    n = 0
+    for item in tracker(Lines(lines, batch_size, marks)):
+        n += 1
+    return n
+
+
+def run_parser(parse, messages, batch_size, marks=None):
+    n = 0
+    for message in messages:
+        if marks is not None:
+            marks.append(time.time())
+        parse(message)
+        n += 1
+    return n
+
+
+TRACKERS = [('bulksize', run_tracker, TrackBulkSize),
+            ('bulkerrors', run_tracker, TrackBulkError),
+            ('slowsearch', run_tracker, TrackSlowSearch),
+            ('shapes', run_tracker, TrackSearchShapes),
+            ('users', run_tracker, TrackUsers),
+            ('latency', run_tracker, TrackLatency),
+            ('errors', run_tracker, TrackErrors),
+            ('parse', run_parser, error.parse),
+            ('parseElasticsearchError', run_parser,
+             error.parseElasticsearchError)]
+
+
+def maxrss():
+    "Peak resident memory, in KB"
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(run, target, inputs, conn):
+    """In a fresh process: throughput by batches of 1000, then the time of
+    each input, alone in its batch, and the peak memory of both."""
+    before = maxrss()
+    start = time.time()
+    outputs = run(target, inputs, 1000)
+    seconds = time.time() - start
+    marks = []
+    run(target, inputs, 1, marks)
+    marks.append(time.time())
+    latencies = sorted((b - a) * 1e6 for a, b in zip(marks, marks[1:]))
+    peak = maxrss()
+    conn.send(dict(inputs=len(inputs), outputs=outputs, seconds=seconds,
+                   events_per_s=len(inputs) / seconds,
+                   mb_per_s=sum(len(i) for i in inputs) / seconds / 1e6,
+                   latency_us=dict(mean=sum(latencies) / len(latencies),
+                                   p50=percentile(latencies, 50),
+                                   p90=percentile(latencies, 90),
+                                   p99=percentile(latencies, 99),
+                                   max=latencies[-1]),
+                   maxrss_kb=peak, growth_kb=peak - before))
+
+
+def bench_trackers(source=10000, output=None, names=None):
+    """Each tracker, in its own process, over the same packets: synthetic
+    ones, or the ones of a file. Results are written to output, as JSON."""
+    if isinstance(source, int):
+        lines = list(Traffic(seed=0).lines(source))
+        origin = "synth %i seed 0" % source
+    else:
+        lines = list(read_lines(source))
+        origin = source
+    messages = []  # errors of Elasticsearch, for the parsers
+    for line in lines:
+        packet = loads(line)
+        code = (packet.get('http') or {}).get('response', {}).get('code')
+        if code >= 400:
+            body = packet['response_raw'].split('\r\n\r\n', 1)[-1]
+            messages.append(loads(body)['error'])
+    results = dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), source=origin,
+                   python=platform.python_version(), events=len(lines),
+                   bytes=sum(len(l) for l in lines), trackers={})
+    print "{events} packets, {mb:.1f} MB, {errors} errors, from {source}".format(
+        events=len(lines), mb=results['bytes'] / 1e6, errors=len(messages),
+        source=origin)
+    for name, run, target in TRACKERS:
+        if names and name not in names:
+            continue
+        inputs = messages if run is run_parser else lines
+        if not inputs:
+            continue
+        result, conn = Pipe(duplex=False)
+        p = Process(target=measure, args=(run, target, inputs, conn))
+        p.start()
+        conn.close()
+        r = results['trackers'][name] = result.recv()
+        p.join()
+        print "{name:24} {events_per_s:9.0f} /s {mb_per_s:6.1f} MB/s µs: \
+p50 {p50:7.1f} p99 {p99:8.1f} max {max:9.1f} peak {peak:5.0f} MB \
++{growth:.1f} MB {outputs} out".format(
+            name=name, peak=r['maxrss_kb'] / 1024.,
+            growth=r['growth_kb'] / 1024., **dict(r, **r['latency_us']))
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+
+def bench_compare(before, after):
+    "Throughput, p99 latency and memory growth of two runs, tracker by tracker"
+    with open(before) as f:
+        before = json.load(f)
+    with open(after) as f:
+        after = json.load(f)
+    if before['source'] != after['source']:
+        print "Beware, not the same packets:", before['source'], \
+            after['source']
+    for name, b in sorted(before['trackers'].items()):
+        a = after['trackers'].get(name)
+        if a is None:
+            continue
+        print "{name:24} {b:9.0f} -> {a:9.0f} /s x{speedup:.2f} p99 µs \
+{bp99:.1f} -> {ap99:.1f} growth MB {bg:.1f} -> {ag:.1f}".format(
+            name=name, b=b['events_per_s'], a=a['events_per_s'],
+            speedup=a['events_per_s'] / b['events_per_s'],
+            bp99=b['latency_us']['p99'], ap99=a['latency_us']['p99'],
+            bg=b['growth_kb'] / 1024., ag=a['growth_kb'] / 1024.)
+
+
+if __name__ == '__main__':
+    import sys
+    args = sys.argv[1:]
+    what = args.pop(0) if args else 'hose'
+    if what == 'hose':
+        host = args.pop(0) if args else 'localhost'
+        count = int(args.pop(0)) if args else 100000
+        bench_hose(host, count)
+    if what == 'parallel':
+        path = args.pop(0)
+        action = args.pop(0) if args else 'users'
+        workers = int(args.pop(0)) if args else 4
+        bench_parallel(path, action, workers)
+    if what == 'errors':
+        bench_errors(int(args.pop(0)) if args else 1000)
+    if what == 'trackers':
+        source = args.pop(0) if args else '10000'
+        source = int(source) if source.isdigit() else source
+        output = args.pop(0) if args else None
+        names = args.pop(0).split(',') if args else None
+        bench_trackers(source, output, names)
+    if what == 'compare':
+        bench_compare(*args[:2])
@@ -3,25 +3,41 @@
 import gevent.monkey
 gevent.monkey.patch_all()
 
-import socket
-import json
 import re
+import signal
 import time
+import calendar
+from functools import partial
 import logging
 import logging.handlers
-from pprint import pprint
 
-import yaml
+import gevent
+from gevent.event import Event as Signal
+from gevent.queue import Queue
 import redis
-from statsd import StatsClient
 from raven import Client as Raven
+try:
+    from ujson import loads
+except ImportError:
+    from json import loads
 
 
 from error import parseElasticsearchError
+from packet import TIMESTAMP, peek, peek_http
+from sketch import Windows, Tops
+from shape import Shapes
+from lru import LRU
+from metrics import Metrics, Statsd, Statsite, metric_name
+from sentry import Reporter
+from stats import Stats
 
 
 SLASHSLASH = re.compile('/+')
-UNQUOTE = re.compile("'([^ \{\}\[\]<>\n]+?)'")
+MESSAGES = {'message', 'pmessage'}
+BULK_ACTION = re.compile(r'\s*\{\s*"(\w+)"')
+BULK_INDEX = re.compile(r'"_index"\s*:\s*"((?:[^"\\]|\\.)*)"')
+BULK_ITEM = re.compile(r'\{\s*"(?:index|create|update|delete)"\s*:\s*\{|'
+                       r'"(error|_index)"\s*:\s*(?:"((?:[^"\\]|\\.)*)")?')
 
 logger = logging.getLogger(__name__)
 
@@ -35,33 +51,81 @@ def split_slugs(uri):
     return slugs
 
 
-class Statsite(object):
-    "Statsite client, it's just statd with TCP connection"
-    def __init__(self, host='localhost', port=8125):
-        self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.conn.connect(('localhost', 8125))
+def index_action(path):
+    "Index (or '-') and action (or '?') of a request path"
+    slugs = split_slugs(path) if path else []
+    index = '-'
+    action = "?"
+    if len(slugs) > 0:
+        if slugs[0][0] != '_':
+            index = slugs[0]
+        if slugs[-1][0] == '_':
+            action = slugs[-1][1:]
+        elif slugs[0][0] == '_':
+            action = slugs[0][1:]
+    return index, action
+
+
+_minutes = {}
+
+
+def epoch(timestamp):
+    "Seconds of a packetbeat @timestamp, like 2014-11-21T10:00:00.123Z"
+    minute = timestamp[:16]
+    t = _minutes.get(minute)
+    if t is None:
+        if len(_minutes) > 1000:
+            _minutes.clear()
+        t = _minutes[minute] = calendar.timegm(
+            time.strptime(minute, '%Y-%m-%dT%H:%M'))
+    return t + float(timestamp[17:-1] or 0)
 
 
 class Event(object):
-    def __init__(self, raw):
+    "weight is the number of packets it stands for, when they are sampled"
+    __slots__ = ('raw', 'timestamp', 'responsetime', 'src_ip', 'agent',
+                 'weight', '_http')
+
+    def __init__(self, raw, weight=1):
         self.raw = raw
+        self.weight = weight
         self.timestamp = raw['@timestamp']
         self.responsetime = raw['responsetime']
         self.src_ip = raw['src_ip']
         self.agent = raw['agent']
+        self._http = None
 
     @property
     def http(self):
-        if self.raw['http'] is None:
-            return None
-        return Http(self.raw)
+        if self._http is None:
+            if self.raw['http'] is None:
+                return None
+            self._http = Http(self.raw)
+        return self._http
 
 
 class Http(object):
+    "Request and response are parsed on first access, once."
+    __slots__ = ('raw', '_request', '_response')
+
     def __init__(self, raw):
         self.raw = raw
-        self.request = HttpRequest(self.raw['http'], self.raw['request_raw'])
-        self.response = HttpResponse(self.raw['http'], self.raw['response_raw'])
+        self._request = None
+        self._response = None
+
+    @property
+    def request(self):
+        if self._request is None:
+            self._request = HttpRequest(self.raw['http'],
+                                        self.raw['request_raw'])
+        return self._request
+
+    @property
+    def response(self):
+        if self._response is None:
+            self._response = HttpResponse(self.raw['http'],
+                                          self.raw['response_raw'])
+        return self._response
 
 
 def parse_headers(raw):
@@ -72,90 +136,256 @@ def parse_headers(raw):
     return d
 
 
+def cut(message):
+    "Where the header of a raw HTTP message ends, found once."
+    if message._cut is None:
+        message._cut = message.raw.find('\r\n\r\n')
+    return message._cut
+
+
+def head(message):
+    c = cut(message)
+    if c == -1:
+        return message.raw
+    return message.raw[:c]
+
+
+def body(message):
+    c = cut(message)
+    if c == -1:
+        return ''
+    return message.raw[c + 4:]
+
+
 class HttpRequest(object):
+    __slots__ = ('raw', 'host', 'uri', 'method', 'path', 'arguments',
+                 '_cut', '_header', '_body', '_json')
+
     def __init__(self, http, raw):
         self.raw = raw
         self.host = http['host']
         self.uri = http['request']['uri']
         self.method = http['request']['method']
-        s = self.uri.split('?')
-        self.path = s[0]
-        if len(s) > 1:
-            self.arguments = s[1]
-        else:
-            self.arguments = None
-        self.path = s[0]
-        self.header, self.body = self.raw.split('\r\n\r\n', 1)
-        self.header = parse_headers(self.header)
+        self.path, q, arguments = self.uri.partition('?')
+        self.arguments = arguments if q else None
+        self._cut = None
+        self._header = None
+        self._body = None
+        self._json = None
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = body(self)
+        return self._body
 
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = parse_headers(head(self))
+        return self._header
 
     @property
     def json(self):
-        return json.loads(self.body)
+        if self._json is None:
+            self._json = loads(self.body)
+        return self._json
 
     def __len__(self):
         return len(self.raw)
 
 
 class HttpResponse(object):
+    __slots__ = ('raw', 'code', '_cut', '_header', '_body', '_json')
+
     def __init__(self, http, raw):
         self.raw = raw
         self.code = http['response']['code']
+        self._cut = None
         self._header = None
         self._body = None
         self._json = None
 
-    def _parse(self):
-        self._header, self._body = self.raw.split('\r\n\r\n', 1)
-
     def __len__(self):
         return len(self.raw)
 
     @property
     def body(self):
         if self._body is None:
-            self._parse()
+            self._body = body(self)
         return self._body
 
     @property
     def header(self):
         if self._header is None:
-            self._parse()
+            self._header = head(self)
         return self._header
 
     @property
     def json(self):
         if self._json is None:
-            self._json = json.loads(self.body)
+            self._json = loads(self.body)
         return self._json
 
 
-class EventsHose(object):
+class Source(object):
+    """Events, decoded from the lists of (channel, raw message) yielded by
+    raw_batches(). A finite source, like a file, can wait for its consumers,
+    a live one can't."""
+    finite = False
+    batch_bytes = 4 << 20  # of raw packets decoded at once
+
+    def __init__(self, decoder=loads):
+        self.decoder = decoder
+        self.routes = []
+        self.taps = []  # called with each raw batch
+        self.stats = Stats()
+        self.shedder = None  # sampling, when lagging
+
+    def add_route(self, route):
+        """Packets wanted by a tracker: route(method, path, code) is checked
+        before decoding, None wants everything."""
+        self.routes.append(route)
+
+    def wanted(self, raw):
+        if not self.routes or None in self.routes:
+            return True
+        method, path, code = peek_http(raw)
+        if path is None:
+            return True
+        for route in self.routes:
+            if route(method, path, code):
+                return True
+        return False
+
+    def raw_batches(self):
+        raise NotImplementedError()
+
+    def now(self):
+        "The time packets are compared to, for the lag, None for no lag"
+        return time.time()
+
+    def raw(self):
+        """raw_batches, seen by the taps. Other greenlets (stats, metrics,
+        the store) get their turn between two batches, even when packets
+        keep coming."""
+        stats = self.stats
+        for batch in self.raw_batches():
+            gevent.sleep(0)
+            ts = peek(TIMESTAMP, batch[-1][1])
+            try:
+                stats.received(len(batch), ts and epoch(ts), self.now())
+            except ValueError:
+                stats.received(len(batch))
+            if self.taps:
+                resume = stats.enter('taps')
+                for tap in self.taps:
+                    tap(batch)
+                stats.enter(resume)
+            yield batch
+
+    def batches(self):
+        """Lists of decoded events, the unwanted ones are never decoded. A
+        raw batch is decoded by chunks of about batch_bytes."""
+        loads = self.decoder
+        stats = self.stats
+        batches = self.raw()
+        while True:
+            resume = stats.enter('read')
+            batch = next(batches, None)
+            if batch is None:
+                stats.enter(resume)
+                return
+            stats.enter('decode')
+            wanted = [data for chan, data in batch if self.wanted(data)]
+            shedder = self.shedder
+            if shedder is not None:
+                shedder.update(stats.lag, stats.backlog and stats.backlog[0])
+            if shedder is None or not shedder.level:
+                wanted = [(data, 1) for data in wanted]
+            else:
+                n = len(wanted)
+                wanted = [(data, shedder.keep(data)) for data in wanted]
+                wanted = [(data, w) for data, w in wanted if w]
+                stats.shedding(n - len(wanted), shedder.weight)
+            events = []
+            size = 0
+            for data, w in wanted:
+                events.append(Event(loads(data), w))
+                size += len(data)
+                if size >= self.batch_bytes:
+                    stats.decoded(len(events), size)
+                    stats.enter(resume)
+                    yield events
+                    stats.enter('decode')
+                    events = []
+                    size = 0
+            stats.decoded(len(events), size)
+            stats.enter(resume)
+            if events:
+                yield events
+
+    def __iter__(self):
+        for batch in self.batches():
+            for event in batch:
+                yield event
+
+
+class EventsHose(Source):
     "Source of events"
-    def __init__(self, redis_connection, chan='packetbeat/*'):
+    def __init__(self, redis_connection, chan='packetbeat/*', batch_size=1000,
+                 decoder=loads):
+        Source.__init__(self, decoder)
         self.r = redis_connection
         self.chan = chan
+        self.batch_size = batch_size
+        self.pubsub = None
         assert self.r.ping()
 
-    def __iter__(self):
-        pubsub = self.r.pubsub()
+    def backlog(self):
+        """Bytes and messages waiting for us in Redis, in the output buffer
+        of the subscription, found by its address in CLIENT LIST."""
+        connection = self.pubsub and self.pubsub.connection
+        if connection is None or connection._sock is None:
+            return None
+        addr = "%s:%i" % connection._sock.getsockname()[:2]
+        for client in self.r.client_list():
+            if client.get('addr') == addr:
+                return int(client['omem']), int(client['oll'])
+
+    def raw_batches(self):
+        """Blocks on the socket until something is published, then drains
+        every message already buffered, up to batch_size."""
+        pubsub = self.pubsub = self.r.pubsub()
         pubsub.psubscribe(self.chan)
         while True:
-            msg = pubsub.get_message()
-            if msg is None:
-                time.sleep(0.1)
-                continue
-            if msg['type'] in {'message', 'pmessage'}:
-                packet = json.loads(msg['data'])
-                yield Event(packet)
+            batch = []
+            msg = pubsub.handle_message(pubsub.parse_response(block=True))
+            while msg is not None:
+                if msg['type'] in MESSAGES:
+                    batch.append((msg['channel'], msg['data']))
+                    if len(batch) >= self.batch_size:
+                        break
+                msg = pubsub.get_message()
+            if batch:
+                yield batch
 
 
 class Filter(object):
+    "route(method, path, code) tells the source which packets are wanted"
+    route = None
+
     def __init__(self, events):
         self.events = events
+        if hasattr(events, 'add_route'):
+            events.add_route(self.route)
 
 
 class BulkFilter(Filter):
+    @staticmethod
+    def route(method, path, code):
+        return path.endswith('/_bulk')
+
     def bulk(self, event):
         raise NotImplementedError()
 
@@ -163,29 +393,115 @@ class BulkFilter(Filter):
         for event in self.events:
             if event.http is None:
                 continue
-            if event.http.request.path == '/_bulk':
+            if event.http.request.path.endswith('/_bulk'):
                 e = self.bulk(event)
                 if e is not None:
                     for b in e:
                         yield b
 
 
+def scan_bulk(raw, pos=0, index=None):
+    """One pass over the NDJSON of a bulk, from pos, without copying it.
+
+    Returns the index of each action, bytes by index, and the number of
+    lines. Actions without _index go to index, the one of the URL.
+    """
+    actions = []
+    sizes = {}
+    lines = 1
+    end = len(raw)
+    while pos < end:
+        eol = raw.find('\n', pos)
+        if eol == -1:
+            eol = end
+        else:
+            lines += 1
+        m = BULK_ACTION.match(raw, pos, eol)
+        if m is None:  # blank line
+            pos = eol + 1
+            continue
+        idx = BULK_INDEX.search(raw, pos, eol)
+        name = index if idx is None else idx.group(1)
+        size = eol + 1 - pos
+        pos = eol + 1
+        if m.group(1) != 'delete' and pos < end:  # its source
+            eol = raw.find('\n', pos)
+            if eol == -1:
+                eol = end
+            else:
+                lines += 1
+            size += eol + 1 - pos
+            pos = eol + 1
+        actions.append(name)
+        sizes[name] = sizes.get(name, 0) + size
+    return actions, sizes, lines
+
+
+def scan_bulk_errors(raw, pos=0):
+    """One pass over the response of a bulk, from pos, without decoding it.
+
+    Returns the position and the _index of each failed item. Quotes are
+    escaped inside JSON strings, an "error" key can't be some text.
+    """
+    failed = []
+    item = -1
+    index = None
+    error = False
+    for m in BULK_ITEM.finditer(raw, pos):
+        key = m.group(1)
+        if key is None:  # a new item
+            if error:
+                failed.append((item, index))
+            item += 1
+            index = None
+            error = False
+        elif key == 'error':
+            error = True
+        elif index is None:
+            index = m.group(2)
+    if error:
+        failed.append((item, index))
+    return failed
+
+
 class TrackBulkSize(BulkFilter):
-    "Iterator for tracking bulks, their sizes, their errors."
+    """Iterator for tracking bulks, their sizes, their errors.
+
+    indices holds documents, bytes and errors of each index of the bulk.
+    Counts and sizes are multiplied by weight in totals.
+    """
 
     def bulk(self, event):
-        errors = len([a for a in event.http.response.json['items']
-                      if 'error' in a.values()[0]])
-        idx = event.http.response.json['items'][0].values()[0]['_index']
+        rq = event.http.request
+        slugs = split_slugs(rq.path)
+        start = len(rq.raw) if cut(rq) == -1 else cut(rq) + 4
+        actions, sizes, lines = scan_bulk(rq.raw, start,
+                                          slugs[0] if len(slugs) > 1 else None)
+        indices = {}
+        for name, size in sizes.items():
+            indices[name] = dict(docs=0, bytes=size, errors=0)
+        for name in actions:
+            indices[name]['docs'] += 1
+        response = event.http.response
+        start = len(response.raw) if cut(response) == -1 else cut(response) + 4
+        failed = scan_bulk_errors(response.raw, start)
+        for i, name in failed:
+            if i < len(actions):
+                name = actions[i]
+            indices.setdefault(name, dict(docs=0, bytes=0, errors=0))
+            indices[name]['errors'] += 1
+        errors = len(failed)
+        idx = actions[0] if actions else None
 
         yield dict(agent=event.agent, ts=event.timestamp,
                    source=event.src_ip, code=event.http.response.code,
-                   method=event.http.request.method,
+                   method=rq.method,
                    responsetime=event.responsetime, index=idx,
-                   request_len=len(event.http.request),
-                   response_len=len(event.http.response),
-                   bulk_size=len(event.http.request.body.split('\n')),
-                   bulk_errors=errors, uri=event.http.request.uri)
+                   indices=indices,
+                   request_len=len(rq),
+                   response_len=len(response),
+                   bulk_size=lines,
+                   bulk_errors=errors, uri=rq.uri, weight=event.weight)
 
 
 class TrackBulkError(BulkFilter):
@@ -197,36 +513,58 @@ class TrackBulkError(BulkFilter):
                 yield event, info
 
 
-class TrackSlowSearch(object):
+class TrackSlowSearch(Filter):
 
     def __init__(self, events, *index):
-        self.events = events
+        Filter.__init__(self, events)
         self.index = index
 
-    def __iter__(self):
+    @staticmethod
+    def route(method, path, code):
+        return path.endswith('/_search')
+
+    def searches(self):
+        "Searches, with their slugs, of the wanted indices"
         for event in self.events:
+            if event.http is None:
+                continue
             slugs = event.http.request.path.split('/')[1:]
             if slugs[-1] != '_search':
                 continue
-            yield event.timestamp, event.responsetime, slugs[:-1]
+            if self.index and (len(slugs) < 2 or slugs[0] not in self.index):
+                continue
+            yield event, slugs[:-1]
 
+    def __iter__(self):
+        for event, slugs in self.searches():
+            yield event.timestamp, event.responsetime, slugs
 
-class TrackUsers(object):
 
-    def __init__(self, events):
-        self.events = events
+class TrackSearchShapes(TrackSlowSearch):
+    "Searches, with the fingerprint and the shape of their query"
+
+    def __init__(self, events, *index):
+        TrackSlowSearch.__init__(self, events, *index)
+        self.shapes = Shapes()
+
+    def __iter__(self):
+        for event, slugs in self.searches():
+            rq = event.http.request
+            fingerprint, shape = self.shapes.fingerprint(rq.body,
+                                                         rq.arguments)
+            yield epoch(event.timestamp), event.responsetime, \
+                slugs[0] if slugs else '_all', fingerprint, shape
+
+
+class TrackUsers(Filter):
+    """Requests, one tuple each, ending with the weight of the event and the
+    index."""
 
     def __iter__(self):
         for event in self.events:
             if event.http is None:
                 continue
-            slugs = split_slugs(event.http.request.path)
-            action = "?"
-            if len(slugs) > 0:
-                if slugs[-1][0] == '_':
-                    action = slugs[-1][1:]
-                elif slugs[0][0] == '_':
-                    action = slugs[0][1:]
+            index, action = index_action(event.http.request.path)
             if action == "bulk":
                 bulk_size = event.http.request.body.count('\n') + 1
             else:
@@ -237,127 +575,545 @@ class TrackUsers(object):
                 '%s:%i' % (event.raw['dst_ip'], event.raw['dst_port']), \
                 '[%s]' % event.http.request.header.get('user-agent', ''), \
                 event.http.request.method, action, event.http.request.uri, \
-                bulk_size, request_len, response_len
+                bulk_size, request_len, response_len, event.weight, index
 
 
-class TrackErrors(object):
-    def __init__(self, events):
-        self.events = events
+class TrackLatency(Filter):
+    "Response times, keyed by (index, action, agent), with their weight"
+
+    def __iter__(self):
+        for event in self.events:
+            if event.http is None:
+                continue
+            index, action = index_action(event.http.request.path)
+            yield epoch(event.timestamp), (index, action, event.agent), \
+                event.responsetime, event.weight
+
+
+def json_body(message):
+    "JSON body of a request or a response, None when it is empty or not JSON"
+    try:
+        return message.json
+    except ValueError:
+        return None
+
+
+class TrackErrors(Filter):
+    """Failed requests. The response is the decoded Elasticsearch error, or,
+    for the others (a HEAD, an empty body), just its status, with a None
+    error."""
+    @staticmethod
+    def route(method, path, code):
+        return code is None or code >= 400
 
     def __iter__(self):
         for event in self.events:
             if event.http is not None and event.http.response.code >= 400:
                 rq = event.http.request
+                response = event.http.response
+                message = json_body(response)
+                if not isinstance(message, dict) or \
+                        not isinstance(message.get('error'), basestring):
+                    message = dict(status=response.code, error=None)
                 yield (dict(method=rq.method,
                             url="http://%s%s" % (rq.host, rq.path),
                             query_string=rq.arguments,
                             headers=rq.header),
-                       event.http.request.json, #[FIXME] handling mjson bulk
-                       event.http.response.json,
+                       json_body(rq),  # [FIXME] handling mjson bulk
+                       message,
                        event.responsetime,
                        event.agent,
                        event.raw['src_ip'],
-                       event.http.request.body
+                       event.http.request.body,
+                       event.timestamp
                        )
 
 
-if __name__ == '__main__':
-    import sys
-    args = sys.argv
-    args.reverse()
-    args.pop()
-    if len(args):
-        action = args.pop()
-    else:
-        action = 'bulksize'
-    if len(args):
-        host = args.pop()
-    else:
-        host = 'localhost'
-    if len(args):
-        chan = args.pop()
-    else:
-        chan = 'packetbeat/*'
-    print("host", host, chan)
-    r = redis.StrictRedis(host=host, port=6379, db=0)
-    if action == 'bulksize':
-        for event in TrackBulkSize(EventsHose(r, chan)):
-            print "{agent} {ts} {source} {responsetime} ms \
+class Branch(object):
+    """Events of one action of a FanOut, through a queue of at most size
+    events. None in the queue ends it. Once its action died, its events are
+    dropped, nothing waits for it."""
+    def __init__(self, fanout, name, size):
+        self.fanout = fanout
+        self.name = name
+        self.queue = Queue()
+        self.size = size
+        self.pending = 0  # events in the queue
+        self.room = Signal()
+        self.routes = []
+        self.dropped = 0
+        self.dropping = False
+        self.dead = False
+        self.stats = fanout.events.stats
+
+    def add_route(self, route):
+        self.routes.append(route)
+        if hasattr(self.fanout.events, 'add_route'):
+            self.fanout.events.add_route(route)
+
+    def wanted(self, event):
+        if not self.routes or None in self.routes or event.http is None:
+            return True
+        rq = event.http.request
+        for route in self.routes:
+            if route(rq.method, rq.path, event.http.response.code):
+                return True
+        return False
+
+    def put(self, events, block=False):
+        """Queue events. Without room for them, wait for it when block, else
+        drop them."""
+        while self.pending and self.pending + len(events) > self.size:
+            if self.dead:
+                return
+            if not block:
+                if not self.dropping:
+                    print "%s is too slow, dropping events" % self.name
+                    self.dropping = True
+                self.dropped += len(events)
+                return
+            self.room.clear()
+            self.room.wait()
+        if self.dead:
+            return
+        if self.dropping:
+            print "%s caught up, %i events dropped so far" % (self.name,
+                                                              self.dropped)
+            self.dropping = False
+        self.pending += len(events)
+        self.queue.put(events)
+
+    def close(self):
+        self.queue.put(None)
+
+    def die(self, greenlet):
+        "Its action raised: forget the queue, wake up who waits for room"
+        print "%s died, its events are dropped: %r" % (self.name,
+                                                      greenlet.exception)
+        self.dead = True
+        self.queue = Queue()
+        self.pending = 0
+        self.room.set()
+
+    def __iter__(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            self.pending -= len(batch)
+            self.room.set()
+            for event in batch:
+                yield event
+            gevent.sleep(0)  # a busy tracker must not starve the others
+
+
+class FanOut(object):
+    """One source, decoded once, for many actions.
+
+    Each action runs in its own greenlet, fed through its own queue of at
+    most queue_size events. From a live source, when a slow sink lets its
+    queue fill up, its events are dropped, the other actions don't wait; a
+    finite source waits for it. An action which raises is dropped, the
+    source ends once they are all dead.
+    """
+    def __init__(self, events, queue_size=10000):
+        self.events = events
+        self.queue_size = queue_size
+        self.branches = []
+
+    def run(self, **actions):
+        """actions are named callables consuming a source of events, run
+        until the source ends"""
+        greenlets = []
+        for name, action in actions.items():
+            branch = Branch(self, name, self.queue_size)
+            self.branches.append(branch)
+            greenlet = gevent.spawn(action, branch)
+            greenlet.link_exception(branch.die)
+            greenlets.append(greenlet)
+        gevent.sleep(0)  # let the trackers declare their routes
+        self.events.stats.enter('fanout')
+        for batch in self.events.batches():
+            alive = [branch for branch in self.branches if not branch.dead]
+            if not alive:
+                break
+            for branch in alive:
+                events = [e for e in batch if branch.wanted(e)]
+                if events:
+                    branch.put(events, self.events.finite)
+            gevent.sleep(0)  # let the branches work
+        for branch in self.branches:
+            branch.close()
+        gevent.joinall(greenlets)
+
+
+def timed(name, tracker):
+    """Items of tracker; with the stats of its source, its time is told apart
+    from the time of its sink."""
+    stats = getattr(tracker.events, 'stats', None)
+    if stats is None:
+        return tracker
+    return stats.timed(name, tracker)
+
+
+def bulksize(events, metrics=None, store=None):
+    for event in timed('bulksize', TrackBulkSize(events)):
+        print "{agent} {ts} {source} {responsetime} ms \
 ⬆︎ {request_len} bytes ⬇︎ {response_len} bytes {index} {bulk_size} \
 {bulk_errors}☠ [{code} {method} {uri}]".format(**event)
-    if action == 'bulkerrors':
-        for event, error in TrackBulkError(EventsHose(r)):
-            print "{agent} {ts} {source} ".format(agent=event.agent,
-                                                  ts=event.timestamp,
-                                                  source=event.src_ip),
-            print "{status} {_index} {_type} {_id} : {error}".format(**error)
-    if action == 'slowsearch':
-        output = None
-        last = None
-        for ts, rt, slugs in TrackSlowSearch(EventsHose(r, chan)):
-            if last is None or last != ts[:10]:
-                last = ts[:10]
-                if output is not None:
-                    output.close()
-                output = open('slow-{ts}.csv'.format(ts=ts[:10]), 'a')
-            line = "{ts};{rt};{slugs}".format(ts=ts, rt=rt,
-                                              slugs=";".join(slugs))
-            output.write(line)
-            output.write('\n')
-            print line
-    if action == 'users':
+        for name, index in sorted(event['indices'].items()):
+            print "    {name} {docs} docs {bytes} bytes {errors}☠".format(
+                name=name, **index)
+            if metrics is not None:
+                for k in ('docs', 'bytes', 'errors'):
+                    metrics.incr(metric_name('bulk', name, k),
+                                 index[k] * event['weight'])
+            if store is not None:
+                w = event['weight']
+                store.add(epoch(event['ts']), 'bulk', name or '-', 'bulk',
+                          event['agent'], w, index['docs'] * w,
+                          index['bytes'] * w, index['errors'] * w,
+                          event['responsetime'])
+        if metrics is not None:
+            metrics.timing('bulk', event['responsetime'], event['weight'])
+
+
+def bulkerrors(events, metrics=None):
+    for event, error in timed('bulkerrors', TrackBulkError(events)):
+        print "{agent} {ts} {source} ".format(agent=event.agent,
+                                              ts=event.timestamp,
+                                              source=event.src_ip),
+        print "{status} {_index} {_type} {_id} : {error}".format(**error)
+        if metrics is not None:
+            metrics.incr(metric_name('bulkerrors', error['_index'],
+                                     error['status']))
+
+
+def slowsearch(events, metrics=None):
+    output = None
+    last = None
+    for ts, rt, slugs in timed('slowsearch', TrackSlowSearch(events)):
+        if metrics is not None:
+            metrics.timing(metric_name('search', *slugs), rt)
+        if last is None or last != ts[:10]:
+            last = ts[:10]
+            if output is not None:
+                output.close()
+            output = open('slow-{ts}.csv'.format(ts=ts[:10]), 'a')
+        line = "{ts};{rt};{slugs}".format(ts=ts, rt=rt,
+                                          slugs=";".join(slugs))
+        output.write(line)
+        output.write('\n')
+        print line
+
+
+def shapes(events, width=60, step=None, top=10, metrics=None):
+    "Every window, the top searches shapes, by cumulated response time"
+    windows = Windows(width, step, other=('_other', '-'))
+    known = LRU(10000)
+
+    def emit(closed):
+        closed.sort(key=lambda c: c[3]['sum'], reverse=True)
+        for start, end, key, summary in closed[:top]:
+            print "{start} {index} {fingerprint} {count} searches ms: \
+total {sum} p50 {p50:.0f} p99 {p99:.0f} max {max} {shape}".format(
+                start=time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(start)),
+                index=key[0], fingerprint=key[1],
+                shape=known.get(key[1], '?')[:200], **summary)
+            if metrics is not None:
+                metrics.gauge(metric_name('shapes', key[0], key[1], 'total'),
+                              summary['sum'])
+
+    for ts, rt, index, fingerprint, shape in timed(
+            'shapes', TrackSearchShapes(events)):
+        known[fingerprint] = shape
+        emit(windows.add(ts, (index, fingerprint), rt))
+    if windows.panes:  # the source ended, a replay
+        emit(windows.close())
+
+
+def users(events, width=60, top=10, log=False, metrics=None):
+    """Every window, the top (client, user agent, action, index) by requests,
+    bytes in and out, and response time. With log, every request goes to
+    users.log too."""
+    if log:
         logger.setLevel(logging.INFO)
         handler = logging.handlers.TimedRotatingFileHandler('users.log', when='D', interval=1)
         handler.setLevel(logging.INFO)
         logger.addHandler(handler)
-        statsd = StatsClient('localhost', 8125)
-        for a in TrackUsers(EventsHose(r, chan)):
-            t = a[2]
-            action = a[7]
-            statsd.timing('action.%s' % action, int(t))
-            logger.info(" ".join([str(b) for b in a]))
-    if action == 'errors':
-        log = logging.getLogger('raven')
-        log.setLevel(logging.DEBUG)
-        handler = logging.handlers.TimedRotatingFileHandler('raven.log', when='D', interval=1)
-        handler.setLevel(logging.DEBUG)
-        log.addHandler(handler)
-        hose = EventsHose(r, chan)
-        dumper = yaml.Dumper
-        for rq, query, message, ts, agent, source, body in TrackErrors(hose):
-            status = message['status']
-            print status
-            request = UNQUOTE.subn(r"\1", yaml.dump(query, allow_unicode=True,
-                                                    default_flow_style=False).replace('!!python/unicode ', ''))[0]
-            print request
-            rq['data'] = dict(body=body)
-            error = parseElasticsearchError(message['error'])
-            exceptions = set((error['name'],))
-            indices = set()
-            last = None
-            for i, s in error['exceptions'].items():
+    if metrics is None:
+        metrics = Metrics(Statsd('localhost', 8125))
+        metrics.start()
+    tops = Tops(width)
+
+    def emit(closed):
+        for start, end, sketches in closed:
+            for measure in tops.measures:
+                for rank, (k, count, error) in enumerate(
+                        sketches[measure].top(top)):
+                    print "{start} {measure} #{rank} {count}±{error} {ip} \
+{agent} {action} {index}".format(
+                        start=time.strftime('%Y-%m-%dT%H:%M:%S',
+                                            time.gmtime(start)),
+                        measure=measure, rank=rank + 1, count=count,
+                        error=error, ip=k[0], agent=k[1], action=k[2],
+                        index=k[3])
+
+    for a in timed('users', TrackUsers(events)):
+        t = a[2]
+        action = a[7]
+        w = a[12]
+        metrics.timing(metric_name('action', action), int(t), w)
+        if log:
+            logger.info(" ".join([str(b) for b in a[:12]]))  # the 12 fields
+        key = (a[3].rpartition(':')[0], a[5], action, a[13])
+        emit(tops.add(epoch(a[0]), key, (w, a[10] * w, a[11] * w, t * w)))
+    if tops.window is not None:  # the source ended, a replay
+        emit(tops.close())
+
+
+def errors(events, metrics=None, window=60, store=None):
+    log = logging.getLogger('raven')
+    log.setLevel(logging.DEBUG)
+    handler = logging.handlers.TimedRotatingFileHandler('raven.log', when='D', interval=1)
+    handler.setLevel(logging.DEBUG)
+    log.addHandler(handler)
+    reporter = Reporter(raven, window)
+    reporter.start()
+    for rq, query, message, ts, agent, source, body, timestamp in timed(
+            'errors', TrackErrors(events)):
+        status = message.get('status')
+        if metrics is not None:
+            metrics.incr(metric_name('errors', status))
+        if message['error'] is None:  # not from Elasticsearch, not for Sentry
+            index = index_action(rq['url'].split('/', 3)[-1])[0]
+            print status, 'HTTP', None, index
+            if store is not None:
+                store.add(epoch(timestamp), 'error', index, str(status),
+                          'HTTP', errors=1, responsetime=ts)
+            continue
+        error = parseElasticsearchError(message['error'])
+        indices = set()
+        last = None
+        for i, s in error['exceptions'].items():
+            if '][' in i:
                 indices.add(i.split('][')[1])
+            if s:
                 last = s[-1].keys()[0]
-                for ex in s:
-                    exceptions.add(ex.keys()[0])
-            pprint(error)
-
-            exception = {'values': [{'type': error['name'],
-                                      'value': error['description']
-                                      }]}
-
-            raven.http_context(rq)
-            raven.tags_context(dict( agent=agent,
-                                    lastException=last
-                                    ))
-            raven.extra_context(dict(request=request,
-                                     stacktrace=error['exceptions'],
-                                     indices=list(indices),
-                                     source=source,
-                                     description=error['description']))
-            print raven.capture('raven.events.Exception', time_spent=ts,
-                                message="%s:%s" % (error['description'], last),
-                                culprit=error['name'],
-                                data=dict(exception=exception)
-                                )
+        if not indices:
+            indices.add(index_action(rq['url'].split('/', 3)[-1])[0])
+        index = ",".join(sorted(indices))
+        print status, error['name'], last, index
+        if store is not None:
+            store.add(epoch(timestamp), 'error', index, str(status),
+                      error['name'], errors=1, responsetime=ts)
+        reporter.report(error, last, index, request=rq, query=query,
+                        body=body, agent=agent, source=source, ts=ts)
+    reporter.close()  # the source ended, a replay
+
+
+def latency(events, width=60, step=None, metrics=None, store=None):
+    windows = Windows(width, step, other=('_other', '?', '-'))
+
+    def emit(closed):
+        for start, end, key, summary in closed:
+            print "{start} {index} {action} {agent} {count} requests ms: \
+p50 {p50:.0f} p90 {p90:.0f} p99 {p99:.0f} max {max}".format(
+                start=time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(start)),
+                index=key[0], action=key[1], agent=key[2], **summary)
+            if metrics is not None:
+                for k in ('count', 'p50', 'p90', 'p99', 'max'):
+                    metrics.gauge(metric_name('latency', key[0], key[1],
+                                              key[2], k), summary[k])
+
+    for ts, key, rt, w in timed('latency', TrackLatency(events)):
+        if store is not None:
+            store.add(ts, 'latency', key[0], key[1], key[2], w,
+                      responsetime=rt)
+        emit(windows.add(ts, key, rt, w))
+    if windows.panes:  # the source ended, a replay
+        emit(windows.close())
+
+
+def capture(events, metrics=None):
+    "Nothing but the --capture of the raw packets: none is decoded"
+    if hasattr(events, 'add_route'):
+        events.add_route(lambda method, path, code: False)
+    for event in events:
+        pass
 
+
+def query(store, since, until, by=3600, **where):
+    "Prints the rollups of a Store, merged by periods of by seconds"
+    for ts, kind, index, action, key, row in store.query(since, until, by,
+                                                         **where):
+        requests, count, size, errs, total, max_time, sketch = row
+        summary = dict(p50='-', p99='-')
+        if sketch is not None:
+            summary = dict((k, '%.0f' % sketch.quantile(q))
+                           for k, q in (('p50', .5), ('p99', .99)))
+        print "{start} {kind} {index} {action} {key} {requests:.0f} requests \
+{count:.0f} docs {size:.0f} bytes {errors:.0f}☠ {rate:.2%} ms: mean {mean:.0f} \
+p50 {p50} p99 {p99} max {max}".format(
+            start=time.strftime('%Y-%m-%dT%H:%M', time.gmtime(ts)),
+            kind=kind, index=index, action=action, key=key or '-',
+            requests=requests, count=count, size=size, errors=errs,
+            rate=errs / (count or requests or 1),
+            mean=total / requests if requests else 0,
+            max='-' if max_time is None else '%.0f' % max_time, **summary)
+
+
+ACTIONS = dict(bulksize=bulksize, bulkerrors=bulkerrors,
+               slowsearch=slowsearch, users=users, errors=errors,
+               latency=latency, shapes=shapes, capture=capture)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Elasticsearch traffic, \
+from packetbeat.")
+    parser.add_argument('action', nargs='?', default='bulksize',
+                        help="one of %s, or a comma separated list of them, \
+sharing one subscription, or query, to read the --store" % ", ".join(
+                            sorted(ACTIONS)))
+    parser.add_argument('host', nargs='?', default='localhost')
+    parser.add_argument('chan', nargs='?', default='packetbeat/*')
+    parser.add_argument('--workers', type=int, default=0,
+                        help="shard the action (bulksize, bulkerrors, \
+slowsearch or users) across worker processes, and print its merged tallies")
+    parser.add_argument('--shard', default='agent',
+                        choices=['agent', 'channel', 'round'])
+    parser.add_argument('--interval', type=int, default=10,
+                        help="seconds between two merged tallies, and \
+between two pipeline stats")
+    parser.add_argument('--window', type=int, default=60,
+                        help="seconds of latency, shapes and users windows, \
+and of errors grouping before sending them to Sentry")
+    parser.add_argument('--step', type=int, default=None,
+                        help="seconds between two sliding latency windows")
+    parser.add_argument('--top', type=int, default=10,
+                        help="search shapes, and users by measure, \
+reported by window")
+    parser.add_argument('--log-users', action='store_true',
+                        help="log every request to users.log")
+    parser.add_argument('--statsd', metavar='HOST:PORT',
+                        help="send metrics to statsd, over UDP")
+    parser.add_argument('--statsite', metavar='HOST:PORT',
+                        help="send metrics to statsite, over TCP")
+    parser.add_argument('--replay', metavar='FILE', nargs='+',
+                        help="packets from files, instead of Redis")
+    parser.add_argument('--speed', type=float, default=None,
+                        help="replay at the recorded pace, that many times \
+faster, instead of as fast as possible")
+    parser.add_argument('--capture', metavar='DIRECTORY',
+                        help="record the packets, in hourly gzipped files")
+    parser.add_argument('--shed', metavar='SECONDS', type=float, default=None,
+                        help="when lagging more than that, or when Redis \
+holds more than 4 MB for us, sample connections, until caught up")
+    parser.add_argument('--store', metavar='FILE',
+                        help="SQLite file of minute rollups, written by \
+bulksize, latency and errors, read by query")
+    parser.add_argument('--since', default='1d',
+                        help="query from then: 2014-11-21, \
+2014-11-21T10:00, or 90m, 6h, 2d ago")
+    parser.add_argument('--until', default='0m', help="query until then")
+    parser.add_argument('--by', default='hour',
+                        choices=['minute', 'hour', 'day'])
+    parser.add_argument('--kind', choices=['bulk', 'latency', 'error'],
+                        help="query only this kind of rollups")
+    parser.add_argument('--index', help="query only these indices, a glob")
+    parser.add_argument('--es-action', metavar='ACTION',
+                        help="query only this Elasticsearch action, like \
+search, or this status of errors")
+    parser.add_argument('--stats-port', type=int, default=None,
+                        help="serve the pipeline stats, as JSON, on \
+http://127.0.0.1:PORT/")
+    args = parser.parse_args()
+    if args.workers:
+        from parallel import TALLIES
+        if args.action not in TALLIES:
+            parser.error("--workers shards one action, of %s" % ", ".join(
+                sorted(TALLIES)))
+        for option in ('store', 'statsd', 'statsite', 'shed'):
+            if getattr(args, option):
+                parser.error("--%s doesn't work with --workers, they only \
+print their tallies" % option)
+    store = None
+    if args.store:
+        from store import Store, moment
+        store = Store(args.store, args.interval)
+    if args.action == 'query':
+        if store is None:
+            parser.error("query needs a --store")
+        start = time.time()
+        query(store, moment(args.since), moment(args.until),
+              dict(minute=60, hour=3600, day=86400)[args.by],
+              kind=args.kind, index=args.index, action=args.es_action)
+        print "%.1f ms" % ((time.time() - start) * 1000)
+        raise SystemExit()
+    metrics = None
+    for transport in ('statsd', 'statsite'):
+        address = getattr(args, transport)
+        if address is not None:
+            h, p = address.split(':')
+            transport = dict(statsd=Statsd, statsite=Statsite)[transport]
+            metrics = Metrics(transport(h, int(p)), prefix='elasticstat')
+            metrics.start()
+    actions = dict((name, partial(ACTIONS[name], metrics=metrics))
+                   for name in args.action.split(','))
+    for name in ('latency', 'shapes'):
+        if name in actions:
+            actions[name] = partial(actions[name], width=args.window,
+                                    step=args.step)
+    if 'shapes' in actions:
+        actions['shapes'] = partial(actions['shapes'], top=args.top)
+    if 'errors' in actions:
+        actions['errors'] = partial(actions['errors'], window=args.window)
+    if 'users' in actions:
+        actions['users'] = partial(actions['users'], width=args.window,
+                                   top=args.top, log=args.log_users)
+    if store is not None:
+        store.start()
+        for name in ('bulksize', 'latency', 'errors'):
+            if name in actions:
+                actions[name] = partial(actions[name], store=store)
+    if args.workers:
+        from parallel import Coordinator
+        coordinator = Coordinator(args.action, args.workers, args.shard,
+                                  args.interval)
+    if args.replay:
+        from replay import Replay
+        hose = Replay(args.replay, args.speed)
+    else:
+        print("host", args.host, args.chan)
+        r = redis.StrictRedis(host=args.host, port=6379, db=0)
+        hose = EventsHose(r, args.chan)
+    capture = None
+    if args.capture:
+        from replay import Capture
+        capture = Capture(args.capture)
+        hose.taps.append(capture.write)
+    if args.shed:
+        from shed import Shedder
+        hose.shedder = Shedder(args.shed, patience=args.interval)
+    if metrics is not None or args.stats_port or args.shed:
+        hose.stats.start(args.interval, metrics,
+                         getattr(hose, 'backlog', None))
+    if args.stats_port:
+        hose.stats.serve(args.stats_port)
+    # supervisor stops us with SIGTERM: close the capture and the store
+    gevent.signal_handler(signal.SIGTERM, gevent.kill, gevent.getcurrent(),
+                          SystemExit)
+    try:
+        if args.workers:
+            for tally in coordinator.run(hose.raw()):
+                print tally
+        elif len(actions) == 1:
+            actions.values()[0](hose)
+        else:
+            FanOut(hose).run(**actions)
+    finally:
+        if capture is not None:
+            capture.close()
+        if store is not None:
+            store.close()
@@ -1,34 +1,141 @@
-import re
+# encoding:utf8
 
-# shardFailures \{(?P<details>.*?)\}\]
-SearchPhaseExecutionException = re.compile("(?P<blah>.*?); shardFailures (?P<details>.*)\]", re.MULTILINE)
-ShardDetails = re.compile("\{(?P<shard>\[.+?\]\[.+?\]\[.+?\]): (?P<detail>.*?); \}", re.MULTILINE)
+"""
+Parsing Elasticsearch error strings, like:
+
+    Name[description; shardFailures {[node][index][shard]: Exception[detail];
+    nested: Exception[detail]; }{...}]
+
+or a chain of exceptions:
+
+    Name[description]; nested: Exception[detail]; nested: ...
+
+Separators are only trusted when the brackets before them are balanced.
+Brackets are counted by str.count, each character once, the query source
+embedded in the details can be as big as it wants.
+"""
+
+from lru import LRU
+
+
+NESTED = '; nested: '
+SHARD_FAILURES = '; shardFailures '
+GROUP_END = '; }'
 boring_exceptions = ('ElasticsearchException',
                      'UncheckedExecutionException')
 
+cache = LRU(1000)
 
-def parseElasticsearchError(raw):
-    name, blob = raw.split('[', 1)
-    r = dict(name=name, description='', exceptions={})
-    if name == "SearchPhaseExecutionException":
-        m = SearchPhaseExecutionException.match(blob)
-        r['description'] = m.group('blah')
-        details =  m.group('details')
-        for s in ShardDetails.finditer(details):
-            k = s.group('shard')
-            r['exceptions'][k] = []
-            for n in s.group('detail').split('; nested: '):
-                nname, ndetail = n.split('[', 1)
-                if nname not in boring_exceptions:
-                    r['exceptions'][k].append({nname: ndetail[:-1]})
+
+def balance(raw, start, end):
+    "Opened minus closed brackets, between start and end"
+    return raw.count('[', start, end) + raw.count('{', start, end) \
+        - raw.count(']', start, end) - raw.count('}', start, end)
+
+
+def separator(raw, sep, start, end):
+    "First sep between start and end, with balanced brackets before it"
+    depth = 0
+    last = start
+    pos = raw.find(sep, start, end)
+    while pos != -1:
+        depth += balance(raw, last, pos)
+        if depth == 0:
+            return pos
+        last = pos
+        pos = raw.find(sep, pos + 1, end)
+    return -1
+
+
+def chain(raw, start, end):
+    "Name[detail]; nested: Name[detail]... as [(name, start, end of detail)]"
+    exceptions = []
+    while start < end:
+        pos = separator(raw, NESTED, start, end)
+        stop = end if pos == -1 else pos
+        opened = raw.find('[', start, stop)
+        if opened == -1:
+            exceptions.append((raw[start:stop].strip(), stop, stop))
+        else:
+            closed = raw.rfind(']', opened, stop)
+            if closed == -1:  # truncated
+                closed = stop
+            exceptions.append((raw[start:opened].strip(), opened + 1, closed))
+        if pos == -1:
+            break
+        start = pos + len(NESTED)
+    return exceptions
+
+
+def shard_failures(raw, start, end, exceptions):
+    "{[node][index][shard]: chain; }..."
+    while True:
+        start = raw.find('{', start, end)
+        if start == -1:
+            return
+        stop = separator(raw, GROUP_END, start + 1, end)
+        if stop == -1:  # truncated
+            stop = end
+        key = raw.find(']: ', start, stop)
+        if key == -1:
+            return
+        exceptions[raw[start + 1:key + 1]] = [
+            {name: raw[a:b]} for name, a, b in chain(raw, key + 3, stop)
+            if name not in boring_exceptions]
+        start = stop + len(GROUP_END)
+
+
+def parse(raw):
+    r = dict(name=raw, description='', exceptions={})
+    opened = raw.find('[')
+    if opened == -1:
+        return r
+    shards = separator(raw, SHARD_FAILURES, opened + 1, len(raw))
+    if shards == -1:
+        exceptions = chain(raw, 0, len(raw))
+        name, start, end = exceptions[0]
+        r['description'] = raw[start:end]
+        exceptions = exceptions[1:]
     else:
-        r['description'] = blob[:-1]
+        end = len(raw)
+        if not balance(raw, opened, end):  # else truncated
+            if raw.endswith(']'):
+                end -= 1
+            # from the end, the exceptions nested after the first one, up
+            # to the ] closing it, are balanced; inside it, they are not
+            pos = raw.rfind(']' + NESTED, shards)
+            while pos != -1:
+                depth = balance(raw, opened + 1, pos)
+                if depth > 0:
+                    break
+                if depth == 0:
+                    end = pos
+                pos = raw.rfind(']' + NESTED, shards, pos)
+        r['description'] = raw[opened + 1:shards]
+        shard_failures(raw, shards + len(SHARD_FAILURES), end,
+                       r['exceptions'])
+        exceptions = []
+        if raw.startswith(NESTED, end + 1):
+            exceptions = chain(raw, end + 1 + len(NESTED), len(raw))
+    r['name'] = raw[:opened].strip()
+    nested = [{n: raw[a:b]} for n, a, b in exceptions
+              if n not in boring_exceptions]
+    if nested:
+        r['exceptions'][''] = nested
     return r
 
 
-if __name__ == '__main__':
-    from pprint import pprint
-    raw = """\
+def parseElasticsearchError(raw):
+    """name, description, and exceptions, by shard ('' for the ones nested in
+    the top one). Parsed once by raw string, the result is shared: don't
+    modify it."""
+    r = cache.get(raw)
+    if r is None:
+        r = cache[raw] = parse(raw)
+    return r
+
+
+SAMPLES = ["""\
 SearchPhaseExecutionException[Failed to execute phase [query], \
 all shards failed; shardFailures \
 {[FXRGwKYMT4uMBr0RSvgyfw][logstash-2014.11.21][0]: \
@@ -59,10 +166,8 @@ nested: UncheckedExecutionException[org.elasticsearch.common.breaker.CircuitBrea
 nested: CircuitBreakingException[Data too large, data for field [@timestamp] would be larger than limit of [1911816192/1.7gb]]; }{[FXRGwKYMT4uMBr0RSvgyfw][logstash-2014.11.21][4]: QueryPhaseExecutionException[[logstash-2014.11.21][4]: query[ConstantScore(*:*)],from[0],size[0]: Query Failed [Failed to execute global facets]]; \
 nested: ElasticsearchException[org.elasticsearch.common.breaker.CircuitBreakingException: Data too large, data for field [@timestamp] would be larger than limit of [1911816192/1.7gb]]; \
 nested: UncheckedExecutionException[org.elasticsearch.common.breaker.CircuitBreakingException: Data too large, data for field [@timestamp] would be larger than limit of [1911816192/1.7gb]]; \
-nested: CircuitBreakingException[Data too large, data for field [@timestamp] would be larger than limit of [1911816192/1.7gb]]; }]"""
-    pprint(parseElasticsearchError(raw))
-    print
-    raw = """\
+nested: CircuitBreakingException[Data too large, data for field [@timestamp] would be larger than limit of [1911816192/1.7gb]]; }]""",
+"""\
 SearchPhaseExecutionException[Failed to execute phase [query], all shards failed; \
 shardFailures {[uq-lldZBQiOfVqzPGJ__3g][trac][0]: \
 SearchParseException[[trac][0]: \
@@ -77,6 +182,11 @@ nested: ElasticsearchParseException[Expected field name but got START_OBJECT "ra
 nested: SearchParseException[[trac][3]: from[-1],size[-1]: Parse Failure [Failed to parse source [{"filter": {"term": {"user": "bob"}, "range": {"changetime": {"to": 1483548912000, "from": 1279089360000}}}, "query": {"query_string": {"query": "choux", "default_operator": "AND"}}, "facets": {"status": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "status"}}, "changetime": {"date_histogram": {"field": "changetime", "interval": "week"}, "facet_filter": {"range": {"changetime": {"to": 1483548912000, "from": 1279089360000}}}}, "_type": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "_type"}}, "component": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "component"}}, "domain": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "domain"}}, "priority": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "priority"}}, "user": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "user"}}, "keywords": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "keywords"}}, "path": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "path"}}}, "highlight": {"pre_tags": ["<b>"], "fields": {"_all": {}, "body": {}, "description": {}, "comment.comment": {}, "summary": {}, "name": {}}, "post_tags": ["</b>"]}}]]]; \
 nested: ElasticsearchParseException[Expected field name but got START_OBJECT "range"]; }{[kuqVEnnDS8qDsUapB2Kl2A][trac][4]: RemoteTransportException[[plouk][inet[/10.20.125.178:9300]][search/phase/query]]; \
 nested: SearchParseException[[trac][4]: from[-1],size[-1]: Parse Failure [Failed to parse source [{"filter": {"term": {"user": "bob"}, "range": {"changetime": {"to": 1483548912000, "from": 1279089360000}}}, "query": {"query_string": {"query": "choux", "default_operator": "AND"}}, "facets": {"status": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "status"}}, "changetime": {"date_histogram": {"field": "changetime", "interval": "week"}, "facet_filter": {"range": {"changetime": {"to": 1483548912000, "from": 1279089360000}}}}, "_type": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "_type"}}, "component": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "component"}}, "domain": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "domain"}}, "priority": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "priority"}}, "user": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "user"}}, "keywords": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "keywords"}}, "path": {"facet_filter": {"term": {"user": "bob"}}, "terms": {"field": "path"}}}, "highlight": {"pre_tags": ["<b>"], "fields": {"_all": {}, "body": {}, "description": {}, "comment.comment": {}, "summary": {}, "name": {}}, "post_tags": ["</b>"]}}]]]; \
-nested: ElasticsearchParseException[Expected field name but got START_OBJECT "range"]; }]"""
-    e = parseElasticsearchError(raw)
-    pprint(e)
+nested: ElasticsearchParseException[Expected field name but got START_OBJECT "range"]; }]"""]
+
+
+if __name__ == '__main__':
+    from pprint import pprint
+    for raw in SAMPLES:
+        pprint(parseElasticsearchError(raw))
+        print
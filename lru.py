@@ -0,0 +1,34 @@
+# encoding:utf8
+
+"""
+Bounded cache, the least recently used key goes first.
+"""
+
+from collections import OrderedDict
+
+
+class LRU(object):
+    def __init__(self, size=1000):
+        self.size = size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def __len__(self):
+        return len(self.data)
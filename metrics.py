@@ -0,0 +1,168 @@
+# encoding:utf8
+
+"""
+Statsd metrics, aggregated in process, sent by packets.
+"""
+
+import random
+import re
+import socket
+
+import gevent
+
+
+NOT_METRIC = re.compile('[^a-zA-Z0-9_-]+')
+
+
+def metric_name(*parts):
+    "Dot separated name, parts can't add dots or colons"
+    return ".".join(NOT_METRIC.sub('_', unicode(part)) for part in parts)
+
+
+class Statsd(object):
+    "UDP, lines are packed in datagrams of at most size bytes"
+    def __init__(self, host='localhost', port=8125, size=1432):
+        self.address = (host, port)
+        self.size = size
+        self.conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, lines):
+        packet = []
+        length = 0
+        for line in lines:
+            if packet and length + len(line) + 1 > self.size:
+                self.conn.sendto("\n".join(packet), self.address)
+                packet = []
+                length = 0
+            packet.append(line)
+            length += len(line) + 1
+        if packet:
+            self.conn.sendto("\n".join(packet), self.address)
+
+
+class Statsite(object):
+    "Statsite client, it's just statd with TCP connection"
+    def __init__(self, host='localhost', port=8125):
+        self.address = (host, port)
+        self.conn = None
+
+    def send(self, lines):
+        data = "\n".join(lines) + "\n"
+        for attempt in range(2):
+            try:
+                if self.conn is None:
+                    self.conn = socket.create_connection(self.address)
+                self.conn.sendall(data)
+                return
+            except socket.error:
+                if self.conn is not None:
+                    self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+
+class Metrics(object):
+    """Counters, gauges and timers, aggregated until the next flush.
+
+    A timer keeps at most max_timings values by interval, a fair sample of
+    them, sent with their sample rate. Beyond max_keys distinct names, new
+    names are dropped: memory is bounded.
+    """
+    def __init__(self, transport, prefix=None, interval=10, max_timings=100,
+                 max_keys=10000):
+        self.transport = transport
+        self.prefix = prefix
+        self.interval = interval
+        self.max_timings = max_timings
+        self.max_keys = max_keys
+        self.dropped = 0
+        self._clear()
+
+    def _clear(self):
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+        self.keys = 0
+
+    def _room(self, values, name):
+        if name in values:
+            return True
+        if self.keys >= self.max_keys:
+            self.dropped += 1
+            return False
+        self.keys += 1
+        return True
+
+    def incr(self, name, n=1):
+        if self._room(self.counters, name):
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        if self._room(self.gauges, name):
+            self.gauges[name] = value
+
+    def timing(self, name, ms, weight=1):
+        "weight is the number of values ms stands for, when sampled"
+        timer = self.timers.get(name)
+        if timer is None:
+            if not self._room(self.timers, name):
+                return
+            timer = self.timers[name] = [0, []]
+        timer[0] += weight
+        if len(timer[1]) < self.max_timings:
+            timer[1].append(ms)
+        else:
+            i = random.randrange(timer[0])
+            if i < self.max_timings:
+                timer[1][i] = ms
+
+    def lines(self):
+        prefix = self.prefix + '.' if self.prefix else ''
+        for name, n in self.counters.items():
+            yield "%s%s:%s|c" % (prefix, name, n)
+        for name, value in self.gauges.items():
+            yield "%s%s:%s|g" % (prefix, name, value)
+        for name, (seen, values) in self.timers.items():
+            rate = ''
+            if seen > len(values):
+                rate = '|@%g' % (float(len(values)) / seen)
+            for ms in values:
+                yield "%s%s:%s|ms%s" % (prefix, name, ms, rate)
+
+    def flush(self):
+        lines = list(self.lines())
+        self._clear()
+        if lines:
+            self.transport.send(lines)
+
+    def run(self):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                self.flush()
+            except socket.error as e:
+                print "metrics are lost", e
+
+    def start(self):
+        "Flush every interval, in a greenlet"
+        return gevent.spawn(self.run)
+
+
+if __name__ == '__main__':
+    # Against a fake statsd
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(('127.0.0.1', 0))
+    metrics = Metrics(Statsd(*listener.getsockname()), prefix='elasticstat',
+                      max_timings=10)
+    for i in range(1000):
+        metrics.incr(metric_name('bulk', 'logstash-2014.11.21', 'docs'), 500)
+        metrics.timing(metric_name('action', 'search'), i)
+    metrics.gauge('lag', 1.5)
+    metrics.flush()
+    listener.settimeout(1)
+    try:
+        while True:
+            print listener.recv(65536)
+    except socket.timeout:
+        pass
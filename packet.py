@@ -0,0 +1,38 @@
+# encoding:utf8
+
+"""
+Peeking into raw packetbeat JSON, without decoding it.
+
+Inside a JSON string every quote is escaped, so a quoted key followed by a
+colon can only be a real key, never a piece of request_raw.
+"""
+
+import re
+
+
+TIMESTAMP = re.compile(r'"@timestamp"\s*:\s*"([^"]+)"')
+AGENT = re.compile(r'"agent"\s*:\s*"((?:[^"\\]|\\.)*)"')
+METHOD = re.compile(r'"method"\s*:\s*"([A-Z]+)"')
+URI = re.compile(r'"uri"\s*:\s*"((?:[^"\\]|\\.)*)"')
+CODE = re.compile(r'"code"\s*:\s*(\d+)')
+SRC_IP = re.compile(r'"src_ip"\s*:\s*"([^"]+)"')
+SRC_PORT = re.compile(r'"src_port"\s*:\s*(\d+)')
+
+
+def peek(pattern, raw):
+    "First group of pattern in raw, or None"
+    m = pattern.search(raw)
+    if m is None:
+        return None
+    return m.group(1)
+
+
+def peek_http(raw):
+    "method, path and status code of a packet, None for what is not found"
+    uri = peek(URI, raw)
+    if uri is not None:
+        uri = uri.partition('?')[0]
+    code = peek(CODE, raw)
+    if code is not None:
+        code = int(code)
+    return peek(METHOD, raw), uri, code
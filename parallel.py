@@ -0,0 +1,199 @@
+# encoding:utf8
+
+"""
+Sharding the analysis across worker processes.
+
+The coordinator reads raw messages, never decodes them, and sends them by
+chunks to the workers, sharded by agent, by channel or round robin. Each
+worker decodes its shard and runs a tracker, summarized in a Tally. Every
+interval, the coordinator asks for the tallies and merges them.
+"""
+
+import time
+import zlib
+from multiprocessing import Process, Pipe
+
+from elasticstat import (Source, TrackBulkSize, TrackBulkError,
+                         TrackSlowSearch, TrackUsers)
+from packet import AGENT, peek, peek_http
+
+
+FLUSH = 'flush'
+
+
+class Tally(object):
+    "Fields by key, mergeable: fields are summed, max_* fields are maxed."
+    def __init__(self):
+        self.counters = {}
+
+    def add(self, key, **fields):
+        counter = self.counters.get(key)
+        if counter is None:
+            self.counters[key] = fields
+            return
+        for k, v in fields.items():
+            if k.startswith('max_'):
+                if v > counter[k]:
+                    counter[k] = v
+            else:
+                counter[k] += v
+
+    def merge(self, counters):
+        for key, fields in counters.items():
+            self.add(key, **dict(fields))
+
+    def clear(self):
+        self.counters = {}
+
+    def __len__(self):
+        return len(self.counters)
+
+    def __str__(self):
+        return "\n".join("%s %s" % (key, " ".join(
+            "%s=%s" % kv for kv in sorted(fields.items())))
+            for key, fields in sorted(self.counters.items()))
+
+
+def tally_bulksize(events, tally):
+    for b in TrackBulkSize(events):
+        w = b['weight']
+        for name, index in b['indices'].items():
+            tally.add(name, bulks=w, docs=index['docs'] * w,
+                      errors=index['errors'] * w, bytes=index['bytes'] * w,
+                      time=b['responsetime'] * w, max_time=b['responsetime'])
+
+
+def tally_bulkerrors(events, tally):
+    for event, error in TrackBulkError(events):
+        tally.add((error['_index'], error['status']), errors=1)
+
+
+def tally_slowsearch(events, tally):
+    for ts, rt, slugs in TrackSlowSearch(events):
+        tally.add("/".join(slugs), searches=1, time=rt, max_time=rt)
+
+
+def tally_users(events, tally):
+    for a in TrackUsers(events):
+        w = a[12]
+        tally.add(a[7], requests=w, bytes_in=a[10] * w, bytes_out=a[11] * w,
+                  time=a[2] * w, max_time=a[2])
+
+
+TALLIES = dict(bulksize=(TrackBulkSize, tally_bulksize),
+               bulkerrors=(TrackBulkError, tally_bulkerrors),
+               slowsearch=(TrackSlowSearch, tally_slowsearch),
+               users=(TrackUsers, tally_users))
+
+
+class Inbox(Source):
+    "Chunks sent by the coordinator, answering its flushes with the tally"
+    def __init__(self, inbox, outbox, tally):
+        Source.__init__(self)
+        self.inbox = inbox
+        self.outbox = outbox
+        self.tally = tally
+
+    def raw_batches(self):
+        while True:
+            chunk = self.inbox.recv()
+            if chunk is None:
+                return
+            if chunk == FLUSH:
+                self.outbox.send(self.tally.counters)
+                self.tally.clear()
+                continue
+            yield chunk
+
+
+def work(action, inbox, outbox):
+    tally = Tally()
+    TALLIES[action][1](Inbox(inbox, outbox, tally), tally)
+    outbox.send(tally.counters)
+
+
+def shard_agent(chan, raw):
+    return zlib.crc32(peek(AGENT, raw) or '')
+
+
+def shard_channel(chan, raw):
+    return zlib.crc32(chan)
+
+
+SHARDS = dict(agent=shard_agent, channel=shard_channel, round=None)
+
+
+class Coordinator(object):
+    """Runs action on workers processes, shards are sent by chunks of
+    chunk_size messages."""
+    def __init__(self, action, workers=2, shard='agent', interval=10,
+                 chunk_size=100):
+        self.action = action
+        self.shard = SHARDS[shard]
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.route = TALLIES[action][0].route
+        self.conns = []
+        self.results = []
+        self.processes = []
+        for i in range(workers):
+            # one way pipes are plain file descriptors, gevent leaves them
+            # blocking
+            inbox, conn = Pipe(duplex=False)
+            result, outbox = Pipe(duplex=False)
+            p = Process(target=work, args=(action, inbox, outbox))
+            p.daemon = True
+            p.start()
+            inbox.close()
+            outbox.close()
+            self.conns.append(conn)
+            self.results.append(result)
+            self.processes.append(p)
+
+    def wanted(self, raw):
+        if self.route is None:
+            return True
+        method, path, code = peek_http(raw)
+        return path is None or self.route(method, path, code)
+
+    def send(self, chunks):
+        for conn, chunk in zip(self.conns, chunks):
+            if chunk:
+                conn.send(chunk)
+
+    def gather(self, message):
+        tally = Tally()
+        for conn in self.conns:
+            conn.send(message)
+        for result in self.results:
+            tally.merge(result.recv())
+        return tally
+
+    def run(self, raw_batches):
+        "Yields the merged Tally, every interval, and at the end"
+        n = len(self.conns)
+        chunks = [[] for i in range(n)]
+        turn = 0
+        last = time.time()
+        for batch in raw_batches:
+            for chan, raw in batch:
+                if not self.wanted(raw):
+                    continue
+                if self.shard is None:
+                    turn = (turn + 1) % n
+                    i = turn
+                else:
+                    i = self.shard(chan, raw) % n
+                chunks[i].append((chan, raw))
+                if len(chunks[i]) >= self.chunk_size:
+                    self.conns[i].send(chunks[i])
+                    chunks[i] = []
+            if time.time() - last >= self.interval:
+                self.send(chunks)
+                chunks = [[] for i in range(n)]
+                last = time.time()
+                yield self.gather(FLUSH)
+        self.send(chunks)
+        yield self.gather(None)
+        for p in self.processes:
+            p.join()
@@ -6,20 +6,65 @@ Ugly hack for handling packetbeat flow as pubsub.
 """
 
 import json
+import time
 
 import redis
 
-def pop2publish(redis_connection, list_channel='packetbeat', publish_channel='/packetbeat/'):
+from packet import AGENT, peek
+
+
+def take(redis_connection, list_channel, size):
+    "Pop up to size entries in one round trip."
+    p = redis_connection.pipeline()
+    p.lrange(list_channel, 0, size - 1)
+    p.ltrim(list_channel, size, -1)
+    return p.execute()[0]
+
+
+def pop2publish(redis_connection, list_channel='packetbeat',
+                publish_channel='/packetbeat/', batch_size=1000, latency=0,
+                report=10):
+    """Relay the list to pubsub, by batches.
+
+    Blocks until an entry is here, then waits up to latency seconds for the
+    batch to fill, and publishes it through one pipeline. Prints its
+    throughput every report seconds.
+    """
+    relayed = batches = 0
+    last = time.time()
     while True:
         chan, raw = redis_connection.blpop(list_channel)
-        packet = json.loads(raw)
-        print packet['agent']
-        r.publish(publish_channel + packet['agent'], raw)
+        batch = [raw]
+        deadline = time.time() + latency
+        while len(batch) < batch_size:
+            more = take(redis_connection, list_channel, batch_size - len(batch))
+            batch.extend(more)
+            if len(batch) >= batch_size or time.time() >= deadline:
+                break
+            if not more:
+                time.sleep(min(0.01, latency))
+        p = redis_connection.pipeline(transaction=False)
+        for raw in batch:
+            agent = peek(AGENT, raw)
+            if agent is None:
+                agent = json.loads(raw)['agent']
+            p.publish(publish_channel + agent, raw)
+        p.execute()
+        relayed += len(batch)
+        batches += 1
+        now = time.time()
+        if now - last >= report:
+            print "{rate:.0f} messages/s, {size:.1f} messages/batch".format(
+                rate=relayed / (now - last), size=float(relayed) / batches)
+            relayed = batches = 0
+            last = now
 
 
 if __name__ == '__main__':
 
     import sys
     host = sys.argv[1]
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0
     r = redis.StrictRedis(host=host, port=6379, db=0)
-    pop2publish(r)
+    pop2publish(r, batch_size=batch_size, latency=latency)
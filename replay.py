@@ -0,0 +1,154 @@
+# encoding:utf8
+
+"""
+Packets from files, and to files: one raw packetbeat JSON by line, gzipped
+or not.
+"""
+
+import gzip
+import mmap
+import os
+import time
+import zlib
+
+from elasticstat import Source, epoch, loads
+from packet import TIMESTAMP, peek
+
+
+GZIP_MAGIC = '\x1f\x8b'
+
+
+def ended(decompressor):
+    "Whether a gzip decompressobj got the trailer of its member"
+    try:
+        decompressor.decompress('\0')  # after the end, input is left unused
+    except zlib.error:
+        return False
+    return bool(decompressor.unused_data)
+
+
+def gunzip_lines(f, size=1 << 16):
+    """Lines of a gzipped file, member after member, read by size bytes.
+
+    A file cut short, like the current one of a killed capture, has no
+    trailer: its lines stop at the last complete one, without a CRC error.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    rest = ''
+    for data in iter(lambda: f.read(size), ''):
+        while data:
+            text = rest + decompressor.decompress(data)
+            data = decompressor.unused_data
+            if data:  # the next member
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            text = text.split('\n')
+            rest = text.pop()
+            for line in text:
+                yield line + '\n'
+    rest += decompressor.flush()
+    if rest and ended(decompressor):
+        yield rest
+    elif rest:
+        print "%s is cut short, its last line is skipped" % f.name
+
+
+def lines(path):
+    "Lines of a file, mapped in memory, or read by 64 kB when gzipped"
+    with open(path, 'rb') as f:
+        if f.read(2) == GZIP_MAGIC:
+            f.seek(0)
+            for line in gunzip_lines(f):
+                yield line
+            return
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for line in iter(m.readline, ''):
+                yield line
+        finally:
+            m.close()
+
+
+class Replay(Source):
+    """Packets of files, as fast as possible, or paced like when they were
+    recorded, speed times faster. Paced, the lag is behind the recorded time
+    being replayed; as fast as possible, there is no lag."""
+    finite = True
+
+    def __init__(self, paths, speed=None, batch_size=1000, decoder=loads):
+        Source.__init__(self, decoder)
+        self.paths = paths
+        self.speed = speed
+        self.batch_size = batch_size
+        self.start = None  # (recorded, replayed) times of the first packet
+
+    def now(self):
+        if self.speed and self.start is not None:
+            return self.start[0] + (time.time() - self.start[1]) * self.speed
+
+    def raw_batches(self):
+        for path in self.paths:
+            batch = []
+            for line in lines(path):
+                if not line.strip():
+                    continue
+                if self.speed:
+                    ts = epoch(peek(TIMESTAMP, line))
+                    if self.start is None:
+                        self.start = ts, time.time()
+                    start = self.start
+                    wait = start[1] + (ts - start[0]) / self.speed \
+                        - time.time()
+                    if wait > 0:
+                        if batch:
+                            yield batch
+                            batch = []
+                        time.sleep(wait)
+                batch.append((path, line))
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+
+class Capture(object):
+    """Writes raw batches to directory/prefix-TIME.jsonl.gz files, a new one
+    every rotate seconds, or rotate_size bytes. Each batch is flushed, a
+    killed capture loses nothing already written."""
+    def __init__(self, directory, prefix='packetbeat', rotate=3600,
+                 rotate_size=1 << 30):
+        self.directory = directory
+        self.prefix = prefix
+        self.rotate = rotate
+        self.rotate_size = rotate_size
+        self.output = None
+
+    def open(self):
+        if self.output is not None:
+            self.output.close()
+        now = time.time()
+        path = os.path.join(self.directory, '%s-%s.jsonl.gz' % (
+            self.prefix, time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))))
+        self.output = gzip.open(path, 'ab', 1)
+        self.opened = now
+        self.size = 0
+
+    def write(self, batch):
+        "A list of (channel, raw packet), like a Source tap"
+        if self.output is None or self.size >= self.rotate_size or \
+                time.time() - self.opened >= self.rotate:
+            self.open()
+        for chan, raw in batch:
+            self.output.write(raw)
+            self.size += len(raw)
+            if not raw.endswith('\n'):  # replayed lines end with one
+                self.output.write('\n')
+                self.size += 1
+        self.output.flush(zlib.Z_SYNC_FLUSH)
+
+    def close(self):
+        if self.output is not None:
+            self.output.close()
+            self.output = None
@@ -0,0 +1,67 @@
+# encoding:utf8
+
+"""
+Shapes of search queries: their structure, without their literal values.
+
+Two searches with the same shape cost about the same, whatever the user
+typed in them.
+"""
+
+from hashlib import md5
+
+try:
+    from ujson import loads
+except ImportError:
+    from json import loads
+
+from lru import LRU
+
+
+def shape(query):
+    "Structure of a decoded query: keys are kept, values become ?"
+    if isinstance(query, dict):
+        return '{%s}' % ','.join('%s:%s' % (k, shape(v))
+                                 for k, v in sorted(query.items()))
+    if isinstance(query, list):
+        shapes = []
+        for v in query:
+            s = shape(v)
+            if s not in shapes:
+                shapes.append(s)
+        return '[%s]' % ','.join(shapes)
+    return '?'
+
+
+def arguments_shape(arguments):
+    "Names of the query string arguments"
+    if not arguments:
+        return ''
+    return '&'.join(sorted(set(a.split('=', 1)[0]
+                               for a in arguments.split('&'))))
+
+
+class Shapes(object):
+    """Fingerprints of search requests, memoized by a hash of the raw body
+    in a LRU of size entries."""
+    def __init__(self, size=10000):
+        self.cache = LRU(size)
+
+    def fingerprint(self, body, arguments=None):
+        "(fingerprint, shape) of a request"
+        key = (len(body), hash(body), arguments)
+        known = self.cache.get(key)
+        if known is not None:
+            return known
+        if body.strip():
+            try:
+                s = shape(loads(body))
+            except ValueError:
+                s = '!'
+        else:
+            s = '-'
+        a = arguments_shape(arguments)
+        if a:
+            s = '%s?%s' % (s, a)
+        known = md5(s.encode('utf8')).hexdigest()[:12], s
+        self.cache[key] = known
+        return known
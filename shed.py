@@ -0,0 +1,76 @@
+# encoding:utf8
+
+"""
+Load shedding: when the consumer lags, some connections are dropped, the
+others count for them.
+"""
+
+import time
+import zlib
+
+from packet import AGENT, SRC_IP, SRC_PORT, peek
+
+
+class Shedder(object):
+    """Sampling, deterministic by connection, when the consumer falls behind.
+
+    At level k, a packet is kept when the hash of its connection (src_ip and
+    src_port, or agent) is a multiple of 2 ** k, and weighs 2 ** k. The
+    connections kept at level k + 1 are some of those of level k.
+
+    The level goes up when the lag is over high seconds, or the backlog over
+    max_backlog bytes, at most once every patience seconds. It goes down once
+    both are low (lag under low seconds, backlog under a quarter) for calm
+    seconds.
+    """
+    def __init__(self, high=30, low=None, max_backlog=4 << 20, max_level=6,
+                 patience=10, calm=60):
+        self.high = high
+        self.low = high / 4. if low is None else low
+        self.max_backlog = max_backlog
+        self.max_level = max_level
+        self.patience = patience
+        self.calm = calm
+        self.level = 0
+        self.changed = 0
+        self.since = None  # low since
+
+    def update(self, lag, backlog=None):
+        "lag in seconds, backlog in bytes, None for unknown"
+        now = time.time()
+        if (lag is not None and lag > self.high) or \
+                (backlog is not None and backlog > self.max_backlog):
+            self.since = None
+            if self.level < self.max_level and \
+                    now - self.changed >= self.patience:
+                self.level += 1
+                self.changed = now
+                print "lagging, 1 connection kept out of", 1 << self.level
+            return
+        if (lag is not None and lag > self.low) or \
+                (backlog is not None and backlog > self.max_backlog / 4):
+            self.since = None
+            return
+        if self.since is None:
+            self.since = now
+        if self.level and now - max(self.since, self.changed) >= self.calm:
+            self.level -= 1
+            self.changed = now
+            print "catching up, 1 connection kept out of", 1 << self.level
+
+    @property
+    def weight(self):
+        return 1 << self.level
+
+    def keep(self, raw):
+        "Weight of a raw packet, 0 when it is shed"
+        if not self.level:
+            return 1
+        port = peek(SRC_PORT, raw)
+        if port is None:
+            key = peek(AGENT, raw) or ''
+        else:
+            key = "%s:%s" % (peek(SRC_IP, raw), port)
+        if zlib.crc32(key) & ((1 << self.level) - 1):
+            return 0
+        return 1 << self.level
@@ -0,0 +1,243 @@
+# encoding:utf8
+
+"""
+Fixed memory aggregations: quantile sketches and heavy hitters, over time
+windows.
+"""
+
+import heapq
+import json
+import math
+from collections import deque
+
+
+class Sketch(object):
+    """Quantiles with a relative error of alpha, DDSketch style.
+
+    Values go to logarithmic buckets, at most max_buckets of them: the lowest
+    ones are collapsed. Sketches of the same alpha are mergeable.
+    """
+    __slots__ = ('log_gamma', 'gamma', 'max_buckets', 'buckets', 'zeros',
+                 'count', 'sum', 'min', 'max')
+
+    def __init__(self, alpha=0.02, max_buckets=256):
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value, weight=1):
+        if value > 0:
+            k = int(math.ceil(math.log(value) / self.log_gamma))
+            self.buckets[k] = self.buckets.get(k, 0) + weight
+            if len(self.buckets) > self.max_buckets:
+                self._collapse()
+        else:
+            self.zeros += weight
+        self.count += weight
+        self.sum += value * weight
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def _collapse(self):
+        keys = sorted(self.buckets)
+        n = self.buckets.pop(keys[0])
+        self.buckets[keys[1]] += n
+
+    def merge(self, other):
+        for k, n in other.buckets.items():
+            self.buckets[k] = self.buckets.get(k, 0) + n
+        while len(self.buckets) > self.max_buckets:
+            self._collapse()
+        self.zeros += other.zeros
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or
+                                      other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or
+                                      other.max > self.max):
+            self.max = other.max
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if seen > rank:
+            return 0
+        for k in sorted(self.buckets):
+            seen += self.buckets[k]
+            if seen > rank:
+                return min(max(2 * self.gamma ** k / (self.gamma + 1),
+                               self.min), self.max)
+        return self.max
+
+    def summary(self):
+        return dict(count=self.count, sum=self.sum, min=self.min,
+                    max=self.max, p50=self.quantile(.5),
+                    p90=self.quantile(.9), p99=self.quantile(.99))
+
+    def dumps(self):
+        "JSON, for storage"
+        return json.dumps([self.gamma, self.max_buckets, self.zeros,
+                           self.count, self.sum, self.min, self.max,
+                           self.buckets.items()])
+
+    @classmethod
+    def loads(cls, data):
+        gamma, max_buckets, zeros, count, total, low, high, buckets = \
+            json.loads(data)
+        sketch = cls((gamma - 1) / (gamma + 1), max_buckets)
+        sketch.zeros = zeros
+        sketch.count = count
+        sketch.sum = total
+        sketch.min = low
+        sketch.max = high
+        sketch.buckets = dict(buckets)
+        return sketch
+
+
+class Windows(object):
+    """Sketches by key, over windows of width seconds, sliding by step
+    seconds (tumbling without step).
+
+    Time is cut in panes of step seconds, a window merges the last
+    width / step panes. A pane holds at most max_keys keys, the others are
+    counted as the other key.
+    """
+    def __init__(self, width=60, step=None, max_keys=1000, other='_other',
+                 **sketch):
+        self.step = step or width
+        self.size = max(1, int(width // self.step))
+        self.max_keys = max_keys
+        self.other = other
+        self.sketch = sketch
+        self.panes = deque()  # (pane number, {key: Sketch})
+
+    def add(self, ts, key, value, weight=1):
+        """Add value at ts, in seconds. Returns the summaries of the windows
+        closed by this new time, as (start, end, key, summary)."""
+        n = int(ts // self.step)
+        closed = []
+        if not self.panes or n > self.panes[-1][0]:
+            if self.panes:
+                closed = self.close()
+            self.panes.append((n, {}))
+            while self.panes[0][0] <= n - self.size:
+                self.panes.popleft()
+            sketches = self.panes[-1][1]
+        else:
+            sketches = self.panes[-1][1]
+            for p, s in self.panes:  # late, in a still known pane
+                if p == n:
+                    sketches = s
+                    break
+        sketch = sketches.get(key)
+        if sketch is None:
+            if len(sketches) >= self.max_keys:
+                key = self.other
+                sketch = sketches.get(key)
+            if sketch is None:
+                sketch = sketches[key] = Sketch(**self.sketch)
+        sketch.add(value, weight)
+        return closed
+
+    def close(self):
+        "Summaries of the window ending with the last pane"
+        merged = {}
+        for n, sketches in self.panes:
+            for key, sketch in sketches.items():
+                m = merged.get(key)
+                if m is None:
+                    m = merged[key] = Sketch(**self.sketch)
+                m.merge(sketch)
+        end = (self.panes[-1][0] + 1) * self.step
+        start = end - self.size * self.step
+        return [(start, end, key, sketch.summary())
+                for key, sketch in sorted(merged.items())]
+
+
+class SpaceSaving(object):
+    """Heavy hitters, weighted Space-Saving style, in capacity counters.
+
+    A new key, when full, takes the counter of the smallest one, and its
+    count as error: every key weighing more than total / capacity is there,
+    its true weight is between count - error and count. The smallest counter
+    is found in a heap, refreshed lazily.
+    """
+    __slots__ = ('capacity', 'counts', 'errors', 'heap', 'total')
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []  # (count, key), counts may be stale
+        self.total = 0
+
+    def add(self, key, weight=1):
+        self.total += weight
+        counts = self.counts
+        if key in counts:
+            counts[key] += weight
+            return
+        if len(counts) < self.capacity:
+            counts[key] = weight
+            self.errors[key] = 0
+            heapq.heappush(self.heap, (weight, key))
+            return
+        while True:
+            count, smallest = self.heap[0]
+            if counts[smallest] == count:
+                break
+            heapq.heapreplace(self.heap, (counts[smallest], smallest))
+        del counts[smallest]
+        del self.errors[smallest]
+        counts[key] = count + weight
+        self.errors[key] = count
+        heapq.heapreplace(self.heap, (count + weight, key))
+
+    def top(self, k=10):
+        "The k heaviest (key, count, error)"
+        return [(key, count, self.errors[key]) for key, count in
+                heapq.nlargest(k, self.counts.items(), key=lambda kv: kv[1])]
+
+
+class Tops(object):
+    "Heavy hitters of each measure, over tumbling windows of width seconds"
+    def __init__(self, width=60, capacity=1000,
+                 measures=('requests', 'bytes_in', 'bytes_out', 'time')):
+        self.width = width
+        self.capacity = capacity
+        self.measures = measures
+        self.window = None
+        self.sketches = None
+
+    def add(self, ts, key, values):
+        """values of the measures, for key, at ts in seconds. Returns the
+        windows closed by this new time, as (start, end, {measure:
+        SpaceSaving})."""
+        n = int(ts // self.width)
+        closed = []
+        if self.window is None or n > self.window:
+            if self.window is not None:
+                closed = self.close()
+            self.window = n
+            self.sketches = [SpaceSaving(self.capacity)
+                             for m in self.measures]
+        for sketch, value in zip(self.sketches, values):
+            sketch.add(key, value)
+        return closed
+
+    def close(self):
+        "The current window"
+        start = self.window * self.width
+        return [(start, start + self.width,
+                 dict(zip(self.measures, self.sketches)))]
@@ -0,0 +1,172 @@
+# encoding:utf8
+
+"""
+The pipeline watching itself: how late, how fast, where the time goes.
+"""
+
+import json
+import time
+
+import gevent
+from greenlet import getcurrent, gettrace, settrace
+
+
+class Stats(object):
+    """Counters of a source and of its consumers, over an interval.
+
+    Wall time is charged to stages: the running code tells when it enters
+    one, and gets back the stage to restore when it leaves. Stages are read
+    (waiting for packets), taps, decode, fanout, tracker.NAME and sink.NAME.
+    Each greenlet has its own stage: once started, a switch charges the time
+    to the greenlet leaving, and the time in the hub, when every greenlet
+    waits, to the stage of the reading one. Greenlets without a stage are
+    other. It costs two clock reads by batch, two by item yielded by a timed
+    tracker, and one by switch.
+    """
+    def __init__(self):
+        self.stage = 'read'  # the one being charged
+        self.stages = {}  # of each greenlet which entered one
+        self.reader = None  # the greenlet which entered read
+        self.hub = None
+        self.since = self.began = time.time()
+        self.last = {}
+        self.backlog = None
+        self.weight = 1  # of the kept packets, when shedding
+        self._clear()
+
+    def _clear(self):
+        self.seconds = {}
+        self.messages = 0
+        self.events = 0
+        self.bytes = 0
+        self.shed = 0
+        self.lag = None
+        self.max_lag = None
+
+    def _charge(self):
+        now = time.time()
+        self.seconds[self.stage] = self.seconds.get(self.stage, 0) + \
+            now - self.since
+        self.since = now
+
+    def enter(self, stage):
+        "The current greenlet enters stage, returns its previous one"
+        current = getcurrent()
+        previous = self.stages.get(current, 'other')
+        self._charge()
+        self.stages[current] = self.stage = stage
+        if stage == 'read':
+            self.reader = current
+        return previous
+
+    def trace(self, event, args):
+        "greenlet switch tracer: the time goes to the stage of the target"
+        if event in ('switch', 'throw'):
+            self._charge()
+            target = args[1]
+            if target is self.hub:
+                target = self.reader
+            self.stage = self.stages.get(target, 'other')
+
+    def received(self, messages, ts=None, now=None):
+        """A raw batch, ts of its last packet tells the lag behind now, the
+        current time of the source"""
+        self.messages += messages
+        if ts is None or now is None:
+            return
+        lag = now - ts
+        self.lag = lag
+        if self.max_lag is None or lag > self.max_lag:
+            self.max_lag = lag
+
+    def decoded(self, events, size):
+        self.events += events
+        self.bytes += size
+
+    def shedding(self, shed, weight):
+        self.shed += shed
+        self.weight = weight
+
+    def timed(self, name, tracker):
+        "Items of tracker, its time apart from the time of its consumer"
+        inside = 'tracker.' + name
+        outside = 'sink.' + name
+        items = iter(tracker)
+        while True:
+            resume = self.enter(inside)
+            try:
+                item = next(items)
+            except StopIteration:
+                self.enter(resume)
+                return
+            self.enter(outside)
+            yield item
+
+    def snapshot(self):
+        "Rates and shares of the interval, then a new interval"
+        self._charge()
+        now = time.time()
+        elapsed = (now - self.began) or 1e-9
+        self.last = dict(
+            time=now, interval=elapsed,
+            messages_per_s=self.messages / elapsed,
+            events_per_s=self.events / elapsed,
+            bytes_per_s=self.bytes / elapsed,
+            shed_per_s=self.shed / elapsed, weight=self.weight,
+            lag=self.lag, max_lag=self.max_lag,
+            backlog_bytes=self.backlog and self.backlog[0],
+            backlog_messages=self.backlog and self.backlog[1],
+            busy=dict((stage, 100 * seconds / elapsed)
+                      for stage, seconds in self.seconds.items()))
+        self.began = now
+        self._clear()
+        return self.last
+
+    def report(self, metrics):
+        "The last snapshot, as pipeline.* gauges"
+        for k, v in self.last.items():
+            if k == 'busy':
+                for stage, percent in v.items():
+                    metrics.gauge('pipeline.busy.' + stage, '%.1f' % percent)
+            elif k not in ('time', 'interval') and v is not None:
+                metrics.gauge('pipeline.' + k, '%.3f' % v)
+
+    def run(self, interval=10, metrics=None, backlog=None):
+        """Every interval, a snapshot, with the backlog() (bytes, messages)
+        waiting in the source, sent to metrics."""
+        while True:
+            gevent.sleep(interval)
+            if backlog is not None:
+                try:
+                    self.backlog = backlog()
+                except Exception as e:
+                    print "backlog is unknown", e
+                    self.backlog = None
+            self.snapshot()
+            if metrics is not None:
+                self.report(metrics)
+
+    def start(self, interval=10, metrics=None, backlog=None):
+        "Traces the switches, and runs in a greenlet"
+        self.hub = gevent.get_hub()
+        tracer = gettrace()
+
+        def trace(event, args):
+            self.trace(event, args)
+            if tracer is not None:
+                tracer(event, args)
+
+        settrace(trace)
+        return gevent.spawn(self.run, interval, metrics, backlog)
+
+    def serve(self, port, host='127.0.0.1'):
+        "The last snapshot, as JSON, over HTTP"
+        from gevent.pywsgi import WSGIServer
+
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [json.dumps(self.last, sort_keys=True)]
+
+        server = WSGIServer((host, port), application, log=None)
+        server.start()
+        return server
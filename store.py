@@ -0,0 +1,204 @@
+# encoding:utf8
+
+"""
+Rollups of the trackers, by minute, in SQLite, for later questions.
+"""
+
+import calendar
+import sqlite3
+import time
+
+import gevent
+
+from sketch import Sketch
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollups (
+    ts INTEGER NOT NULL,
+    span INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    idx TEXT NOT NULL,
+    action TEXT NOT NULL,
+    key TEXT NOT NULL,
+    requests REAL NOT NULL,
+    count REAL NOT NULL,
+    bytes REAL NOT NULL,
+    errors REAL NOT NULL,
+    time REAL NOT NULL,
+    max_time REAL,
+    sketch TEXT,
+    PRIMARY KEY (ts, span, kind, idx, action, key)
+);
+CREATE INDEX IF NOT EXISTS rollups_idx ON rollups (idx, ts);
+CREATE INDEX IF NOT EXISTS rollups_action ON rollups (action, ts);
+"""
+
+COLUMNS = "requests, count, bytes, errors, time, max_time, sketch"
+
+AGO = dict(m=60, h=3600, d=86400)
+
+
+def moment(text, now=None):
+    "Seconds of 2014-11-21, 2014-11-21T10:00, or of 90m, 6h, 2d ago"
+    if text[-1] in AGO and text[:-1].isdigit():
+        now = time.time() if now is None else now
+        return now - int(text[:-1]) * AGO[text[-1]]
+    for pattern in ('%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(text, pattern))
+        except ValueError:
+            pass
+    raise ValueError("Unknown moment: %s" % text)
+
+
+def merge(row, other):
+    """Adds other to row, lists of requests, count, bytes, errors, time,
+    max_time and Sketch (or None)"""
+    for i in range(5):
+        row[i] += other[i]
+    if other[5] is not None and (row[5] is None or other[5] > row[5]):
+        row[5] = other[5]
+    if other[6] is not None:
+        if row[6] is None:
+            row[6] = other[6]
+        else:
+            row[6].merge(other[6])
+    return row
+
+
+def load(columns):
+    row = list(columns)
+    if row[6] is not None:
+        row[6] = Sketch.loads(row[6])
+    return row
+
+
+class Store(object):
+    """Rollups by (minute, kind, index, action, key): requests, count, bytes,
+    errors, response time and its sketch.
+
+    Rollups wait in memory, and are written by one transaction every
+    interval seconds, or once max_rows are waiting. Minutes older than
+    keep_minutes are merged by hour, hours older than keep_hours are
+    deleted.
+    """
+    def __init__(self, path, interval=10, max_rows=10000,
+                 keep_minutes=7 * 24 * 60, keep_hours=90 * 24):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')  # readers don't wait
+        self.db.executescript(SCHEMA)
+        self.interval = interval
+        self.max_rows = max_rows
+        self.keep_minutes = keep_minutes
+        self.keep_hours = keep_hours
+        self.rows = {}
+        self.latest = None  # the newest ts, replays are not now
+
+    def add(self, ts, kind, index, action, key='', requests=1, count=0,
+            bytes=0, errors=0, responsetime=None):
+        "responsetime is the one of requests requests, at ts in seconds"
+        if ts > self.latest:
+            self.latest = ts
+        k = (int(ts // 60) * 60, kind, index, action, key)
+        row = self.rows.get(k)
+        if row is None:
+            row = self.rows[k] = [0, 0, 0, 0, 0, None, None]
+        row[0] += requests
+        row[1] += count
+        row[2] += bytes
+        row[3] += errors
+        if responsetime is not None:
+            row[4] += responsetime * requests
+            if row[5] is None or responsetime > row[5]:
+                row[5] = responsetime
+            if row[6] is None:
+                row[6] = Sketch()
+            row[6].add(responsetime, requests)
+        if len(self.rows) >= self.max_rows:
+            self.flush()
+
+    def _write(self, ts, span, key, row):
+        kind, index, action, k = key
+        old = self.db.execute(
+            "SELECT %s FROM rollups WHERE ts = ? AND span = ? AND kind = ? \
+AND idx = ? AND action = ? AND key = ?" % COLUMNS,
+            (ts, span, kind, index, action, k)).fetchone()
+        if old is not None:
+            row = merge(load(old), row)
+        self.db.execute(
+            "INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, \
+?, ?, ?, ?, ?)", (ts, span, kind, index, action, k) + tuple(row[:6]) +
+            (None if row[6] is None else row[6].dumps(), ))
+
+    def flush(self):
+        "Writes the waiting rollups, in one transaction"
+        rows = self.rows
+        self.rows = {}
+        with self.db:
+            for key, row in rows.iteritems():
+                self._write(key[0], 60, key[1:], row)
+
+    def compact(self, now=None):
+        "Minutes to hours, and old hours away, before now or the newest ts"
+        if now is None:
+            now = self.latest or time.time()
+        cutoff = int(now - self.keep_minutes * 60) // 3600 * 3600
+        hours = {}
+        with self.db:
+            for columns in self.db.execute(
+                    "SELECT ts, kind, idx, action, key, %s FROM rollups \
+WHERE ts < ? AND span = 60" % COLUMNS, (cutoff, )):
+                key = (columns[0] // 3600 * 3600, ) + columns[1:5]
+                row = load(columns[5:])
+                if key in hours:
+                    merge(hours[key], row)
+                else:
+                    hours[key] = row
+            for key, row in hours.iteritems():
+                self._write(key[0], 3600, key[1:], row)
+            self.db.execute("DELETE FROM rollups WHERE ts < ? AND span = 60",
+                            (cutoff, ))
+            self.db.execute("DELETE FROM rollups WHERE ts < ?",
+                            (int(now - self.keep_hours * 3600), ))
+        return len(hours)
+
+    def query(self, since, until, by=3600, kind=None, index=None,
+              action=None):
+        """Rollups from since to until, in seconds, merged by periods of by
+        seconds, as (ts, kind, index, action, key, row). index is a glob."""
+        where = ["ts >= ?", "ts < ?"]
+        args = [since, until]
+        for column, value, op in [('kind', kind, '='), ('idx', index, 'GLOB'),
+                                  ('action', action, '=')]:
+            if value is not None:
+                where.append("%s %s ?" % (column, op))
+                args.append(value)
+        merged = {}
+        for columns in self.db.execute(
+                "SELECT ts, kind, idx, action, key, %s FROM rollups WHERE %s"
+                % (COLUMNS, " AND ".join(where)), args):
+            key = (columns[0] // by * by, ) + columns[1:5]
+            row = load(columns[5:])
+            if key in merged:
+                merge(merged[key], row)
+            else:
+                merged[key] = row
+        return [key + (row, ) for key, row in sorted(merged.items())]
+
+    def run(self):
+        compacted = time.time()
+        while True:
+            gevent.sleep(self.interval)
+            self.flush()
+            if time.time() - compacted >= 3600:
+                self.compact()
+                compacted = time.time()
+
+    def start(self):
+        "Flush every interval, compact every hour, in a greenlet"
+        return gevent.spawn(self.run)
+
+    def close(self):
+        self.flush()
+        self.db.close()
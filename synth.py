@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# encoding:utf8
+
+"""
+Synthetic packetbeat traffic, for benchmarks and replays.
+
+    synth.py COUNT [OUTPUT.jsonl[.gz]] [--bulk 0.2] [--search 0.5] ...
+
+Packets look like the ones packetbeat publishes for Elasticsearch: bulks of
+random sizes, searches of a few query shapes, errors, and the usual noise.
+The same seed gives the same traffic.
+"""
+
+import gzip
+import json
+import random
+import time
+
+from error import SAMPLES
+
+
+MIX = dict(bulk=0.2, search=0.5, error=0.05, other=0.25)
+
+WORDS = ['error', 'timeout', 'nginx', 'login', 'php', 'java', 'disk', 'cron',
+         'mysql', 'redis', 'deploy', 'kernel', 'oom', 'ssh', 'mail', 'dns']
+
+USER_AGENTS = ['Kibana', 'python-requests/2.4.3', 'logstash/1.4.2',
+               'curl/7.38.0', 'elasticsearch-py/1.2.0']
+
+QUERIES = [
+    lambda r: {'query': {'match': {'message': r.choice(WORDS)}},
+               'size': r.choice([10, 50, 100])},
+    lambda r: {'query': {'term': {'host': 'web%i' % r.randrange(20)}}},
+    lambda r: {'query': {'filtered': {
+        'query': {'query_string': {'query': '%s AND %s' % (
+            r.choice(WORDS), r.choice(WORDS))}},
+        'filter': {'range': {'@timestamp': {
+            'gte': 'now-%im' % r.choice([5, 15, 60])}}}}},
+        'facets': {'hosts': {'terms': {'field': 'host',
+                                       'size': r.choice([5, 10])}}}},
+    lambda r: {'query': {'bool': {'must': [
+        {'match': {'message': r.choice(WORDS)}},
+        {'range': {'@timestamp': {'gte': 'now-1h'}}}]}},
+        'sort': [{'@timestamp': 'desc'}], 'size': 500},
+]
+
+ERRORS = SAMPLES + [
+    "SearchParseException[[logstash-2014.11.21][0]: from[-1],size[-1]: Parse Failure \
+[Failed to parse source [{\"query\": {\"match\": }}]]]",
+    "IndexMissingException[[logstash-2014.11.21] missing]",
+]
+
+OTHERS = ['/_cluster/health', '/_nodes/stats', '/%(index)s/_stats',
+          '/%(index)s/log/%(id)s', '/_cat/indices', '/']
+
+
+class Traffic(object):
+    """Packets of a fake cluster, one every 1 / rate second from start.
+
+    mix is the share of bulk, search, error and other requests. A bulk holds
+    docs documents, each of doc_size bytes (ranges), bulk_errors of them
+    fail. Response times are log-normal, bulks take longer when larger.
+    """
+    def __init__(self, mix=None, docs=(1, 500), doc_size=(50, 1000),
+                 bulk_errors=0.01, indices=8, agents=4, clients=50,
+                 start=1416564000, rate=1000, seed=0):
+        self.random = random.Random(seed)
+        mix = dict(MIX, **(mix or {}))
+        total = float(sum(mix.values()))
+        self.kinds = []
+        cumulated = 0
+        for kind in sorted(mix):
+            cumulated += mix[kind] / total
+            self.kinds.append((cumulated, getattr(self, kind)))
+        self.docs = docs
+        self.doc_size = doc_size
+        self.bulk_errors = bulk_errors
+        self.indices = ['logstash-2014.11.%02i' % (21 - i)
+                        for i in range(indices)]
+        self.agents = ['es%i' % i for i in range(agents)]
+        self.clients = ['10.0.%i.%i' % (i // 250, i % 250 + 2)
+                        for i in range(clients)]
+        self.start = start
+        self.rate = rate
+        self.n = 0
+
+    def timestamp(self):
+        t = self.start + float(self.n) / self.rate
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t)) + \
+            '.%03iZ' % (t * 1000 % 1000)
+
+    def packet(self, method, uri, code, body, response, rt):
+        r = self.random
+        request_raw = "%s %s HTTP/1.1\r\nHost: localhost:9200\r\n\
+User-Agent: %s\r\nContent-Length: %i\r\n\r\n%s" % (
+            method, uri, r.choice(USER_AGENTS), len(body), body)
+        response_raw = "HTTP/1.1 %i %s\r\nContent-Type: application/json; \
+charset=UTF-8\r\nContent-Length: %i\r\n\r\n%s" % (
+            code, 'OK' if code < 400 else 'Error', len(response), response)
+        return {'@timestamp': self.timestamp(), 'type': 'http',
+                'agent': r.choice(self.agents),
+                'src_ip': r.choice(self.clients),
+                'src_port': r.randrange(32768, 61000),
+                'dst_ip': '10.0.100.1', 'dst_port': 9200,
+                'responsetime': int(rt), 'status': 'OK' if code < 400
+                else 'Error', 'http': {'host': 'localhost:9200',
+                                       'request': {'method': method,
+                                                   'uri': uri},
+                                       'response': {'code': code}},
+                'request_raw': request_raw, 'response_raw': response_raw}
+
+    def bulk(self):
+        r = self.random
+        default = r.choice(self.indices) if r.random() < 0.5 else None
+        ts = self.timestamp()
+        lines = []
+        items = []
+        for i in xrange(r.randint(*self.docs)):
+            action = r.choice(['index', 'index', 'index', 'create', 'delete'])
+            index = default or r.choice(self.indices)
+            meta = {'_type': 'log', '_id': '%x' % r.getrandbits(64)}
+            if default is None:
+                meta['_index'] = index
+                lines.append('{"%s": {"_index": "%s", "_type": "log", \
+"_id": "%s"}}' % (action, index, meta['_id']))
+            else:
+                lines.append('{"%s": {"_type": "log", "_id": "%s"}}' % (
+                    action, meta['_id']))
+            if action != 'delete':
+                lines.append('{"@timestamp": "%s", "host": "web%i", \
+"message": "%s"}' % (ts, i % 20, 'x' * r.randint(*self.doc_size)))
+            item = dict(meta, _index=index, _version=1, status=201)
+            if r.random() < self.bulk_errors:
+                item.update(status=400, error="MapperParsingException[failed \
+to parse [message]]; nested: NumberFormatException[For input string: \"x\"]; ")
+            items.append({action: item})
+        response = json.dumps({'took': 10, 'errors': any(
+            'error' in i.values()[0] for i in items), 'items': items})
+        uri = '/_bulk' if default is None else '/%s/log/_bulk' % default
+        return self.packet('POST', uri, 200, "\n".join(lines) + "\n",
+                           response, r.lognormvariate(3, 0.5) + len(items) / 10)
+
+    def search(self):
+        r = self.random
+        index = r.choice(self.indices + ['logstash-*'])
+        body = json.dumps(r.choice(QUERIES)(r))
+        response = json.dumps({'took': 5, 'timed_out': False, 'hits': {
+            'total': r.randrange(100000), 'hits': []}})
+        return self.packet(r.choice(['GET', 'POST']), '/%s/_search' % index,
+                           200, body, response, r.lognormvariate(3, 1.2))
+
+    def error(self):
+        r = self.random
+        index = r.choice(self.indices)
+        error = r.choice(ERRORS).replace('logstash-2014.11.21', index)
+        code = 404 if error.startswith('IndexMissing') else \
+            400 if error.startswith('SearchParse') else 500
+        body = json.dumps(r.choice(QUERIES)(r))
+        return self.packet('POST', '/%s/_search' % index, code, body,
+                           json.dumps({'error': error, 'status': code}),
+                           r.lognormvariate(4, 1))
+
+    def other(self):
+        r = self.random
+        uri = r.choice(OTHERS) % dict(index=r.choice(self.indices),
+                                      id='%x' % r.getrandbits(64))
+        response = json.dumps({'status': 'green', 'ok': True})
+        return self.packet('GET', uri, 200, '', response,
+                           r.lognormvariate(1, 0.5))
+
+    def next(self):
+        p = self.random.random()
+        for cumulated, kind in self.kinds:
+            if p < cumulated:
+                break
+        packet = kind()
+        self.n += 1
+        return packet
+
+    def __iter__(self):
+        return self
+
+    def lines(self, count):
+        "count packets, as raw JSON lines"
+        for i in xrange(count):
+            yield json.dumps(self.next()) + "\n"
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description="Synthetic packetbeat \
+traffic, one JSON packet by line.")
+    parser.add_argument('count', type=int)
+    parser.add_argument('output', nargs='?', help="file, gzipped if it ends \
+with .gz, default is stdout")
+    for kind in sorted(MIX):
+        parser.add_argument('--' + kind, type=float, default=MIX[kind],
+                            help="share of %s requests" % kind)
+    parser.add_argument('--docs', type=int, nargs=2, default=[1, 500],
+                        metavar=('MIN', 'MAX'), help="documents by bulk")
+    parser.add_argument('--doc-size', type=int, nargs=2, default=[50, 1000],
+                        metavar=('MIN', 'MAX'), help="bytes by document")
+    parser.add_argument('--bulk-errors', type=float, default=0.01,
+                        help="share of failed bulk items")
+    parser.add_argument('--rate', type=int, default=1000,
+                        help="packets by second, for timestamps")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    traffic = Traffic(dict((kind, getattr(args, kind)) for kind in MIX),
+                      args.docs, args.doc_size, args.bulk_errors,
+                      rate=args.rate, seed=args.seed)
+    if args.output is None:
+        output = sys.stdout
+    elif args.output.endswith('.gz'):
+        output = gzip.open(args.output, 'wb')
+    else:
+        output = open(args.output, 'wb')
+    for line in traffic.lines(args.count):
+        output.write(line)
+    output.close()